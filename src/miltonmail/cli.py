@@ -2,13 +2,28 @@
 """
 miltonmail CLI
 """
+import contextlib
 import os
+import time
+from datetime import timedelta
+from typing import ContextManager, Dict, Optional
 
 import click
 import coloredlogs
 from click import echo
 
-from miltonmail import __version__, config, core, crypto
+from miltonmail import (
+    __version__,
+    config,
+    core,
+    crypto,
+    fakeimap,
+    loadtest,
+    plan,
+    plugins,
+    ratelimit,
+    storage,
+)
 
 LOGLEVEL: str = os.environ.get("LOGLEVEL", "INFO").upper()
 LOG_FORMAT: str = "%(asctime)s - %(levelname)s - %(message)s"
@@ -23,6 +38,24 @@ except ValueError:
     exit(1)
 
 
+# one limiter per account, shared by all its connections
+_limiters: Dict[str, ratelimit.RateLimiter] = {}
+
+
+def connect(acc: config.Account) -> core.ImapSession:
+    """Open a rate limited IMAP session for the account."""
+    if acc.name not in _limiters:
+        _limiters[acc.name] = ratelimit.RateLimiter(acc.rate_limit or None, acc.burst)
+    return core.ImapSession(
+        acc.server,
+        acc.username,
+        acc.decrypt_password(),
+        acc.port,
+        limiter=_limiters[acc.name],
+        max_retries=acc.max_retries,
+    )
+
+
 @click.group()
 @click.version_option(version=__version__)
 def cli() -> None:
@@ -98,9 +131,7 @@ def show_folders() -> None:
     """List all folders for the current account"""
     acc = config.get_current_account()
 
-    conn = core.login_to_imap(
-        acc.server, acc.username, acc.decrypt_password(), acc.port
-    )
+    conn = connect(acc)
     folders = core.list_folders(conn)
     for folder in folders:
         click.echo(folder)
@@ -118,7 +149,36 @@ def get_items() -> None:
     default="20220101",
     help="Only download attachments from messages after this date (format: YYYYMMDD).",
 )
-def get_attachments(folder: str, cutoff_date: str) -> None:
+@click.option(
+    "--plan",
+    "plan_only",
+    is_flag=True,
+    help="Only estimate the download size and time, do not fetch any messages.",
+)
+@click.option(
+    "--on-collision",
+    type=click.Choice(storage.COLLISION_POLICIES),
+    default="skip",
+    show_default=True,
+    help="How to save a different attachment with an already used name.",
+)
+@click.option(
+    "--no-plugins", is_flag=True, help="Do not run attachment post-processing plugins."
+)
+@click.option(
+    "--plugin-timeout",
+    default=60.0,
+    show_default=True,
+    help="Maximum time in seconds a plugin may spend on one attachment.",
+)
+def get_attachments(
+    folder: str,
+    cutoff_date: str,
+    plan_only: bool,
+    on_collision: str,
+    no_plugins: bool,
+    plugin_timeout: float,
+) -> None:
     """Download attachments from imap folder to current DB_PATH/<account_name>/attachments"""
 
     # Retrieve current account configuration
@@ -129,14 +189,158 @@ def get_attachments(folder: str, cutoff_date: str) -> None:
     dest.mkdir(parents=True, exist_ok=True)
 
     # Log in to IMAP server
-    conn = core.login_to_imap(
-        acc.server, acc.username, acc.decrypt_password(), acc.port
+    conn = connect(acc)
+
+    if plan_only:
+        show_plan(
+            plan.plan_attachments_download(conn, folder, dest, cutoff_date),
+            config.get_throughput(acc.name),
+        )
+        return
+
+    # One-time move of attachments from the flat layout into month shards
+    moved = storage.shared_store(dest).migrate()
+    if moved:
+        echo(f"Moved {moved} attachments into month folders")
+
+    attachment_plugins = {} if no_plugins else plugins.load_plugins()
+    pipeline_context: ContextManager[Optional[plugins.PluginPipeline]]
+    if attachment_plugins:
+        echo(f"Running plugins: {', '.join(attachment_plugins)}")
+        pipeline_context = plugins.PluginPipeline(
+            attachment_plugins, timeout=plugin_timeout
+        )
+    else:
+        pipeline_context = contextlib.nullcontext()
+
+    start = time.monotonic()
+    with pipeline_context as pipeline:
+        fetched_bytes = core.download_attachments_from_folder(
+            conn,
+            folder,
+            output_dir=dest,
+            cutoff_date=cutoff_date,
+            pipeline=pipeline,
+            collision=on_collision,
+        )
+        elapsed = time.monotonic() - start
+
+    # remember throughput for planning, short runs are not representative
+    if fetched_bytes and elapsed > 1:
+        config.save_throughput(acc.name, fetched_bytes / elapsed)
+
+
+def show_plan(transfer: plan.TransferPlan, throughput: Optional[float]) -> None:
+    """Print a download plan."""
+    echo(f"Messages to fetch: {transfer.messages}")
+    echo(f"Data to transfer: {plan.format_size(transfer.message_bytes)}")
+    echo(
+        f"New attachments: {transfer.attachments} "
+        f"({plan.format_size(transfer.attachment_bytes)})"
+    )
+    echo(f"Already saved: {transfer.existing}")
+
+    if throughput:
+        eta = timedelta(seconds=round(transfer.estimated_seconds(throughput)))
+        echo(f"Estimated time: {eta} at {plan.format_size(throughput)}/s")
+    else:
+        echo("Estimated time: unknown, no download throughput measured yet")
+
+
+@cli.command()
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(list(storage.ARCHIVE_FORMATS)),
+    default="zip",
+    show_default=True,
+    help="Archive format.",
+)
+def compact(fmt: str) -> None:
+    """Archive old attachments and apply the retention rules of the current account"""
+    acc = config.get_current_account()
+    store = storage.shared_store(config.DB_PATH / acc.name / "attachments")
+    store.migrate()
+
+    report = store.compact(acc.compact_after_months, acc.retention_months, fmt)
+    echo(
+        f"Archived {report.files_archived} files from {report.shards_archived} months"
     )
+    echo(f"Expired {report.files_expired} files")
+
 
-    # Download attachments, passing the cutoff date
-    core.download_attachments_from_folder(
-        conn, folder, output_dir=dest, cutoff_date=cutoff_date
+@cli.command("loadtest")
+@click.argument("folder", default="INBOX")
+@click.option(
+    "--concurrency", default=4, show_default=True, help="Parallel connections."
+)
+@click.option("--runs", default=8, show_default=True, help="Number of download runs.")
+@click.option(
+    "--cutoff-date",
+    default="20220101",
+    help="Only download attachments from messages after this date (format: YYYYMMDD).",
+)
+@click.option(
+    "--fake",
+    is_flag=True,
+    help="Run against a local stand-in IMAP server instead of the current account.",
+)
+@click.option("--messages", default=50, show_default=True, help="Stand-in messages.")
+@click.option(
+    "--latency", default=0.0, help="Stand-in server delay per command in seconds."
+)
+@click.option(
+    "--throttle-rate", default=0.0, help="Stand-in server throttling probability."
+)
+@click.option(
+    "--disconnect-rate", default=0.0, help="Stand-in server disconnect probability."
+)
+def load_test(
+    folder: str,
+    concurrency: int,
+    runs: int,
+    cutoff_date: str,
+    fake: bool,
+    messages: int,
+    latency: float,
+    throttle_rate: float,
+    disconnect_rate: float,
+) -> None:
+    """Load test attachment downloads, reports latencies and errors"""
+
+    if not fake:
+        acc = config.get_current_account()
+        report = loadtest.run_load_test(
+            lambda: connect(acc), folder, cutoff_date, concurrency, runs
+        )
+        for line in report.summary():
+            echo(line)
+        return
+
+    faults = fakeimap.Faults(latency, throttle_rate, disconnect_rate)
+    server = fakeimap.FakeImapServer(
+        {folder: fakeimap.generate_messages(messages)}, faults=faults
     )
+    limiter = ratelimit.RateLimiter()
+    with server:
+        report = loadtest.run_load_test(
+            lambda: core.ImapSession(
+                server.host,
+                server.username,
+                server.password,
+                server.port,
+                limiter=limiter,
+                backoff=0.1,
+                ssl_context=server.client_context(),
+            ),
+            folder,
+            cutoff_date,
+            concurrency,
+            runs,
+        )
+    for line in report.summary():
+        echo(line)
+    echo(f"Server: {dict(server.stats)}")
 
 
 if __name__ == "__main__":
@@ -5,7 +5,7 @@ import base64
 import json
 from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 from miltonmail.crypto import decrypt_password, encrypt_password
 
@@ -23,6 +23,11 @@ class Account:
     password: str  # Encrypted password (base64 encoded)
     salt: bytes  # Salt stored as bytes
     port: int = 993  # Default IMAP port
+    rate_limit: float = 0.0  # Max IMAP commands per second, 0 for no cap
+    burst: int = 10  # Commands that may be sent back to back
+    max_retries: int = 5  # Retries on throttling or dropped connections
+    compact_after_months: int = 12  # Archive attachments older than this, 0 never
+    retention_months: int = 0  # Delete attachments older than this, 0 keeps all
 
     def __post_init__(self) -> None:
         """Convert salt from base64 to bytes if necessary."""
@@ -85,6 +90,24 @@ def save_config(config: Config) -> None:
         json.dump(config.to_dict(), file, indent=4)
 
 
+def get_throughput(account_name: str) -> Optional[float]:
+    """Get the last measured download throughput (bytes/s) of the account."""
+    stats_file = DB_PATH / account_name / "stats.json"
+    if not stats_file.exists():
+        return None
+    with open(stats_file, "r", encoding="utf8") as file:
+        return json.load(file).get("throughput")
+
+
+def save_throughput(account_name: str, throughput: float) -> None:
+    """Save the measured download throughput (bytes/s) of the account."""
+    stats_dir = DB_PATH / account_name
+    stats_dir.mkdir(parents=True, exist_ok=True)
+
+    with open(stats_dir / "stats.json", "w", encoding="utf8") as file:
+        json.dump({"throughput": throughput}, file, indent=4)
+
+
 # Helper function to add an account
 def add_account(
     name: str, server: str, username: str, password: str, port: int = 993
@@ -1,28 +1,145 @@
+import hashlib
 import logging
 import imaplib
 import email
 from email.header import decode_header
 from email.message import Message
-from typing import List
+from typing import Any, List, Optional, Tuple, Union
 from pathlib import Path
 import re
+import ssl
+import time
 from datetime import datetime
 
+from miltonmail.plugins import PluginPipeline
+from miltonmail.ratelimit import RateLimiter, backoff_delay, is_throttled
+from miltonmail.storage import AttachmentStore, resolve_filename, shared_store
+
 log = logging.getLogger(__name__)
 
 
 def login_to_imap(
-    server: str, username: str, password: str, port: int = 993
+    server: str,
+    username: str,
+    password: str,
+    port: int = 993,
+    ssl_context: Optional[ssl.SSLContext] = None,
 ) -> imaplib.IMAP4_SSL:
     try:
-        connection = imaplib.IMAP4_SSL(server, port)
+        connection = imaplib.IMAP4_SSL(server, port, ssl_context=ssl_context)
         connection.login(username, password)
         return connection
     except imaplib.IMAP4.error as e:
         raise ConnectionError(f"Failed to login to IMAP server: {e}") from e
 
 
-def list_folders(connection: imaplib.IMAP4_SSL) -> List[str]:
+class ImapSession:
+    """
+    IMAP connection with client side rate limiting and automatic retries.
+
+    Commands are paced by the rate limiter. Throttling responses are retried
+    with exponential backoff; after a dropped connection (BYE) the session
+    logs in again and re-selects the current folder before retrying.
+    Provides the part of the imaplib.IMAP4 interface used in this module.
+    """
+
+    def __init__(
+        self,
+        server: str,
+        username: str,
+        password: str,
+        port: int = 993,
+        limiter: Optional[RateLimiter] = None,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        ssl_context: Optional[ssl.SSLContext] = None,
+    ) -> None:
+        self._credentials = (server, username, password, port, ssl_context)
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._mailbox: Optional[str] = None
+        self.connection = login_to_imap(*self._credentials)
+
+    def _reconnect(self) -> None:
+        try:
+            self.connection.shutdown()
+        except OSError:
+            pass
+        self.connection = login_to_imap(*self._credentials)
+        if self._mailbox is not None:
+            # raised so the retry loop handles it, a throttled SELECT is retried
+            status, data = self.connection.select(self._mailbox)
+            if status != "OK":
+                raise imaplib.IMAP4.error(
+                    f"Failed to re-select {self._mailbox} after reconnect: {data}"
+                )
+        log.info("Reconnected to IMAP server")
+
+    def _command(self, name: str, *args: Any) -> Tuple[str, List[Any]]:
+        attempt = 0
+        reconnect = False
+        while True:
+            try:
+                if reconnect:
+                    self._reconnect()
+                    reconnect = False
+                if self.limiter is not None:
+                    self.limiter.acquire()
+
+                status, data = getattr(self.connection, name)(*args)
+                if (
+                    status == "OK"
+                    or not is_throttled(data)
+                    or attempt >= self.max_retries
+                ):
+                    if status == "OK" and self.limiter is not None:
+                        self.limiter.on_success()
+                    return status, data
+                log.warning(f"{name.upper()} throttled: {data}")
+
+            except (imaplib.IMAP4.abort, OSError) as e:
+                # BYE from the server or a dropped connection
+                if attempt >= self.max_retries:
+                    raise
+                log.warning(f"Connection lost during {name.upper()}: {e}")
+                reconnect = True
+
+            except imaplib.IMAP4.error as e:
+                if not is_throttled(str(e)) or attempt >= self.max_retries:
+                    raise
+                log.warning(f"{name.upper()} throttled: {e}")
+
+            if self.limiter is not None:
+                self.limiter.on_throttle()
+            delay = backoff_delay(attempt, self.backoff)
+            log.info(f"Retrying {name.upper()} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def list(self) -> Tuple[str, List[Any]]:
+        return self._command("list")
+
+    def select(self, mailbox: str = "INBOX") -> Tuple[str, List[Any]]:
+        status, data = self._command("select", mailbox)
+        if status == "OK":
+            self._mailbox = mailbox
+        return status, data
+
+    def search(self, charset: Optional[str], *criteria: str) -> Tuple[str, List[Any]]:
+        return self._command("search", charset, *criteria)
+
+    def fetch(self, message_set: Any, message_parts: str) -> Tuple[str, List[Any]]:
+        return self._command("fetch", message_set, message_parts)
+
+    def logout(self) -> Tuple[str, List[Any]]:
+        return self.connection.logout()
+
+
+Connection = Union[imaplib.IMAP4_SSL, ImapSession]
+
+
+def list_folders(connection: Connection) -> List[str]:
     status, folders = connection.list()
     if status != "OK":
         raise RuntimeError("Failed to list folders")
@@ -37,7 +154,7 @@ def list_folders(connection: imaplib.IMAP4_SSL) -> List[str]:
     return folder_list
 
 
-def select_folder(connection: imaplib.IMAP4_SSL, folder: str) -> None:
+def select_folder(connection: Connection, folder: str) -> None:
     """
     Selects the folder, handling spaces and special characters by quoting the folder name.
     """
@@ -49,7 +166,7 @@ def select_folder(connection: imaplib.IMAP4_SSL, folder: str) -> None:
 
 
 def get_messages_from_folder(
-    connection: imaplib.IMAP4_SSL, folder: str, limit: int = 10
+    connection: Connection, folder: str, limit: int = 10
 ) -> List:
     select_folder(connection, folder)
 
@@ -80,6 +197,33 @@ def get_messages_from_folder(
     return messages_list
 
 
+def search_since(connection: Connection, folder: str, cutoff_date: str) -> List[str]:
+    """
+    Select the folder and return ids of messages newer than the cutoff date (YYYYMMDD).
+    """
+    # Select the folder, handle folder names with spaces
+    select_folder(connection, folder)
+
+    cutoff_datetime = datetime.strptime(cutoff_date, "%Y%m%d")
+    imap_cutoff_date = cutoff_datetime.strftime("%d-%b-%Y")
+
+    search_query = f"SINCE {imap_cutoff_date}"
+    status, message_ids = connection.search(None, search_query)
+    if status != "OK":
+        raise RuntimeError(f"Failed to search for messages in {folder}")
+
+    message_ids = message_ids[0].decode().split()
+
+    if not message_ids:
+        log.info(f"No messages found after {cutoff_date}.")
+    else:
+        log.info(
+            f"Found {len(message_ids)} messages after {cutoff_date} in folder: {folder}"
+        )
+
+    return message_ids
+
+
 def decode_mime_words(text: str) -> str:
     """Decodes MIME encoded words (=?UTF-8?B?....?=) into a readable string."""
     decoded_fragments = []
@@ -94,22 +238,38 @@ def format_filename_with_date(message: Message, filename: str) -> str:
     """
     Formats the filename by prepending the date and replacing spaces with underscores.
     """
-    date = email.utils.parsedate_to_datetime(message["Date"]).strftime("%Y%m%d")
+    return format_filename(email.utils.parsedate_to_datetime(message["Date"]), filename)
+
 
+def format_filename(date: datetime, filename: str) -> str:
+    """Formats the filename for a given message date, see format_filename_with_date."""
     filename = filename.replace(" ", "_")
-    formatted_filename = f"{date}_{filename}"
+    formatted_filename = f"{date.strftime('%Y%m%d')}_{filename}"
 
     formatted_filename = re.sub(r"[^A-Za-z0-9_.-]", "", formatted_filename)
 
     return formatted_filename
 
 
-def save_attachments_from_message(message: Message, output_dir: Path) -> None:
+def save_attachments_from_message(
+    message: Message,
+    output_dir: Path,
+    pipeline: Optional[PluginPipeline] = None,
+    store: Optional[AttachmentStore] = None,
+    collision: str = "skip",
+) -> None:
     """
-    Save attachments from an email message to the specified directory.
-    Skip the attachment if it already exists in the folder.
+    Save attachments from an email message to the specified directory, in month shards.
+    Skip the attachment if it already exists in the folder, name collisions
+    with different files are handled according to the `collision` policy.
+    Saved attachments are handed to the plugin pipeline, if given.
+
+    Without a `store`, the store shared for `output_dir` within the process
+    is used, so the shard directories are only scanned once.
     """
     output_dir.mkdir(parents=True, exist_ok=True)
+    if store is None:
+        store = shared_store(output_dir)
 
     for part in message.walk():
         if part.get_content_disposition() == "attachment":
@@ -117,33 +277,48 @@ def save_attachments_from_message(message: Message, output_dir: Path) -> None:
             if filename:
                 filename = decode_mime_words(filename)
                 filename = format_filename_with_date(message, filename)
+                index = store.index(filename)
 
-                filepath = output_dir / filename
+                if collision == "skip" and filename in index:
+                    log.info(f"Attachment already exists: {filename}, skipping...")
+                    continue
 
-                if filepath.exists():
+                payload = part.get_payload(decode=True)
+                if not isinstance(payload, bytes):
+                    payload = b""
+
+                name = resolve_filename(index, filename, payload, collision)
+                if name is None:
                     log.info(f"Attachment already exists: {filename}, skipping...")
                     continue
 
+                directory = store.directory(filename)
+                directory.mkdir(parents=True, exist_ok=True)
+                filepath = directory / name
                 with open(filepath, "wb") as f:
-                    payload = part.get_payload(decode=True)
-                    if payload:
-                        f.write(payload)
+                    f.write(payload)
+                index.add(name, len(payload), hashlib.sha256(payload).hexdigest())
+
+                log.info(f"Saved attachment: {name} to {directory}")
 
-                log.info(f"Saved attachment: {filename} to {output_dir}")
+                if pipeline is not None:
+                    pipeline.submit(filepath, payload)
 
 
 def download_attachments_from_folder(
-    connection: imaplib.IMAP4_SSL,
+    connection: Connection,
     folder: str,
     output_dir: Path,
     cutoff_date: str = "20220101",
-) -> None:
+    pipeline: Optional[PluginPipeline] = None,
+    collision: str = "skip",
+) -> int:
     """
     Download attachments from emails in the specified folder that are newer than the given cutoff date.
 
     Parameters
     ----------
-    connection : imaplib.IMAP4_SSL
+    connection : imaplib.IMAP4_SSL or ImapSession
         The IMAP connection object.
     folder : str
         The folder to download attachments from (e.g., "INBOX").
@@ -151,32 +326,24 @@ def download_attachments_from_folder(
         The directory where attachments should be saved.
     cutoff_date : str
         The cutoff date in 'YYYYMMDD' format. Only messages after this date will be processed.
+    pipeline : PluginPipeline, optional
+        Plugin pipeline to post-process saved attachments.
+    collision : str
+        Policy for attachment name collisions, one of storage.COLLISION_POLICIES.
+
+    Returns
+    -------
+    int
+        Number of message bytes fetched from the server.
     """
     log.info(f"Downloading attachments from {folder} to {output_dir}")
 
-    # Select the folder, handle folder names with spaces
-    select_folder(connection, folder)
-
-    cutoff_datetime = datetime.strptime(cutoff_date, "%Y%m%d")
-    imap_cutoff_date = cutoff_datetime.strftime("%d-%b-%Y")
-
-    search_query = f"SINCE {imap_cutoff_date}"
-    status, message_ids = connection.search(None, search_query)
-    if status != "OK":
-        raise RuntimeError(f"Failed to search for messages in {folder}")
-
-    message_ids = message_ids[0].split()
-
-    if not message_ids:
-        log.info(f"No messages found after {cutoff_date}.")
-        return
-
-    log.info(
-        f"Found {len(message_ids)} messages after {cutoff_date} in folder: {folder}"
-    )
-
+    message_ids = search_since(connection, folder, cutoff_date)
     message_ids.reverse()
 
+    store = shared_store(output_dir)
+
+    fetched_bytes = 0
     for message_id in message_ids:
         status, msg_data = connection.fetch(message_id, "(RFC822)")
         if status != "OK":
@@ -184,5 +351,10 @@ def download_attachments_from_folder(
 
         for response_part in msg_data:
             if isinstance(response_part, tuple):
+                fetched_bytes += len(response_part[1])
                 message = email.message_from_bytes(response_part[1])
-                save_attachments_from_message(message, output_dir)
+                save_attachments_from_message(
+                    message, output_dir, pipeline, store, collision
+                )
+
+    return fetched_bytes
@@ -0,0 +1,660 @@
+"""
+In-process IMAP4rev1 server for tests and load tests
+
+Serves messages from memory over TLS with a self-signed certificate.
+Supports the commands used by miltonmail (LOGIN, LIST, SELECT, SEARCH, FETCH),
+UID commands and IDLE, and can inject faults: latency, throttling responses
+and dropped connections, either at random or scripted per command.
+
+    with FakeImapServer({"INBOX": generate_messages(10)}) as server:
+        session = core.ImapSession(server.host, server.username, server.password,
+                                   server.port, ssl_context=server.client_context())
+"""
+
+import collections
+import email
+import email.utils
+import ipaddress
+import logging
+import random
+import re
+import select
+import socketserver
+import ssl
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage, Message
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple, Type
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+log = logging.getLogger(__name__)
+
+CAPABILITIES = "IMAP4rev1 IDLE UIDPLUS LITERAL+"
+
+# commands that are never hit by random faults
+_NO_FAULT_COMMANDS = ("CAPABILITY", "LOGIN", "LOGOUT")
+
+_ITEM_RE = re.compile(r"[A-Z0-9.]+(?:\[[^\]]*\])?(?:<[\d.]+>)?", re.IGNORECASE)
+_ARG_RE = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|(\((?:[^()]|\([^()]*\))*\))|(\S+))')
+
+
+@dataclass
+class Faults:
+    """Random faults injected into command handling."""
+
+    latency: float = 0.0  # seconds added to every command
+    throttle_rate: float = 0.0  # probability of answering NO [THROTTLED]
+    disconnect_rate: float = 0.0  # probability of dropping the connection
+
+
+@dataclass
+class StoredMessage:
+    uid: int
+    data: bytes
+    date: datetime
+    flags: Tuple[str, ...] = ()
+
+    @property
+    def message(self) -> Message:
+        return email.message_from_bytes(self.data)
+
+
+def generate_messages(
+    count: int,
+    attachment_size: int = 10_000,
+    start: Optional[datetime] = None,
+) -> List[bytes]:
+    """Generate messages with one attachment each, one day apart."""
+    start = start or datetime(2024, 1, 1, tzinfo=timezone.utc)
+    rng = random.Random(count)
+
+    messages = []
+    for i in range(count):
+        msg = EmailMessage()
+        msg["From"] = "Sender <sender@example.com>"
+        msg["To"] = "user@example.com"
+        msg["Subject"] = f"Message {i}"
+        msg["Date"] = email.utils.format_datetime(start + timedelta(days=i))
+        msg["Message-ID"] = f"<{i}@example.com>"
+        msg.set_content(f"Message body {i}")
+        msg.add_attachment(
+            rng.randbytes(attachment_size),
+            maintype="application",
+            subtype="octet-stream",
+            filename=f"attachment_{i}.bin",
+        )
+        messages.append(msg.as_bytes())
+    return messages
+
+
+def generate_certificate(directory: Path, hostname: str = "localhost") -> Path:
+    """Create a self-signed certificate with key, return the path of the pem file."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])
+    now = datetime.now(timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=30))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [
+                    x509.DNSName(hostname),
+                    x509.IPAddress(ipaddress.ip_address("127.0.0.1")),
+                ]
+            ),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+
+    pem_file = directory / "fakeimap.pem"
+    pem_file.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        + cert.public_bytes(serialization.Encoding.PEM)
+    )
+    return pem_file
+
+
+# ------------------------- response formatting -------------------------
+
+
+def _string(value: Optional[Any]) -> bytes:
+    """Format a value as IMAP nstring, quoted or as literal."""
+    if value is None:
+        return b"NIL"
+    data = value if isinstance(value, bytes) else str(value).encode()
+    if b"\r" in data or b"\n" in data or not data.isascii():
+        return b"{%d}\r\n" % len(data) + data
+    return b'"' + data.replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+
+
+def _params(params: Iterable[Tuple[str, Any]]) -> bytes:
+    items = []
+    for key, value in params:
+        if isinstance(value, tuple):
+            value = email.utils.collapse_rfc2231_value(value)
+        items.append(_string(key) + b" " + _string(value))
+    return b"(" + b" ".join(items) + b")" if items else b"NIL"
+
+
+def _addresses(header: Optional[str]) -> bytes:
+    if not header:
+        return b"NIL"
+    addresses = []
+    for name, address in email.utils.getaddresses([header]):
+        mailbox, _, host = address.partition("@")
+        addresses.append(
+            b"(%s NIL %s %s)"
+            % (_string(name or None), _string(mailbox), _string(host or None))
+        )
+    return b"(" + b"".join(addresses) + b")"
+
+
+def envelope(msg: Message) -> bytes:
+    """ENVELOPE of a message."""
+    sender = msg["From"]
+    fields = [
+        _string(msg["Date"]),
+        _string(msg["Subject"]),
+        _addresses(sender),
+        _addresses(msg["Sender"] or sender),
+        _addresses(msg["Reply-To"] or sender),
+        _addresses(msg["To"]),
+        _addresses(msg["Cc"]),
+        _addresses(msg["Bcc"]),
+        _string(msg["In-Reply-To"]),
+        _string(msg["Message-ID"]),
+    ]
+    return b"(" + b" ".join(fields) + b")"
+
+
+def _header_params(part: Message, header: str = "content-type") -> List[Any]:
+    """Parameters of a header, without the main value."""
+    return (part.get_params(header=header) or [])[1:]
+
+
+def _subparts(part: Message) -> List[Message]:
+    payload = part.get_payload()
+    return (
+        [sub for sub in payload if isinstance(sub, Message)]
+        if isinstance(payload, list)
+        else []
+    )
+
+
+def bodystructure(part: Message) -> bytes:
+    """BODYSTRUCTURE of a message part, including extension data."""
+    maintype = part.get_content_maintype()
+    subtype = part.get_content_subtype()
+
+    if maintype == "multipart":
+        children = b"".join(bodystructure(child) for child in _subparts(part))
+        return b"(%s %s %s NIL NIL NIL)" % (
+            children,
+            _string(subtype),
+            _params(_header_params(part)),
+        )
+
+    subparts = _subparts(part)
+    if subparts:  # message/rfc822
+        body = b"".join(inner.as_bytes() for inner in subparts)
+    else:
+        body = str(part.get_payload()).encode(errors="replace")
+    encoding = part.get("Content-Transfer-Encoding", "7bit")
+
+    fields = [
+        _string(maintype),
+        _string(subtype),
+        _params(_header_params(part)),
+        _string(part["Content-ID"]),
+        _string(part["Content-Description"]),
+        _string(encoding),
+        str(len(body)).encode(),
+    ]
+    if maintype == "text":
+        fields.append(str(body.count(b"\n")).encode())
+    elif maintype == "message" and subtype == "rfc822":
+        inner = subparts[0] if subparts else Message()
+        fields += [envelope(inner), bodystructure(inner), b"0"]
+
+    disposition = part.get_content_disposition()
+    if disposition:
+        disposition_params = _header_params(part, "content-disposition")
+        fields.append(b"(%s %s)" % (_string(disposition), _params(disposition_params)))
+    else:
+        fields.append(b"NIL")
+    # md5 before disposition, language and location after it
+    fields.insert(-1, b"NIL")
+    fields += [b"NIL", b"NIL"]
+    return b"(" + b" ".join(fields) + b")"
+
+
+def _parse_args(text: str) -> List[str]:
+    """Split command arguments, quoted strings are unquoted, lists kept as text."""
+    args = []
+    for quoted, group, atom in _ARG_RE.findall(text):
+        if group or atom:
+            args.append(group or atom)
+        else:
+            args.append(re.sub(r"\\(.)", r"\1", quoted))
+    return args
+
+
+def _parse_set(spec: str, values: List[int]) -> List[int]:
+    """Select the values (sequence numbers or uids) matching a set like 1:3,7,9:*"""
+    if not values:
+        return []
+    largest = max(values)
+    selected: Set[int] = set()
+    for item in spec.split(","):
+        first, _, last = item.partition(":")
+        low = largest if first == "*" else int(first)
+        high = low if not last else largest if last == "*" else int(last)
+        low, high = min(low, high), max(low, high)
+        selected.update(value for value in values if low <= value <= high)
+    return sorted(selected)
+
+
+# ------------------------- server -------------------------
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # unbuffered reads, so pending input can be checked during IDLE
+    rbufsize = 0
+    server: "_Server"
+
+    def setup(self) -> None:
+        super().setup()
+        self.authenticated = False
+        self.folder: Optional[str] = None
+
+    @property
+    def fake(self) -> "FakeImapServer":
+        return self.server.fake
+
+    def send(self, data: bytes) -> None:
+        self.wfile.write(data)
+
+    def handle(self) -> None:
+        try:
+            self.request.do_handshake()
+        except (ssl.SSLError, OSError) as e:
+            log.debug(f"TLS handshake failed: {e}")
+            return
+
+        self.send(f"* OK [CAPABILITY {CAPABILITIES}] fake server ready\r\n".encode())
+        while True:
+            try:
+                line = self.rfile.readline()
+            except (ssl.SSLError, OSError):
+                return
+            if not line:
+                return
+
+            tag, _, rest = line.decode(errors="replace").strip().partition(" ")
+            command, _, arguments = rest.partition(" ")
+            command = command.upper()
+            if command == "UID":
+                sub, _, arguments = arguments.partition(" ")
+                command = f"UID {sub.upper()}"
+
+            self.fake.count(command)
+            fault = self.fake.next_fault(command)
+            if fault == "disconnect":
+                self.fake.count("disconnected")
+                self.send(b"* BYE connection dropped\r\n")
+                return
+            if fault == "throttle":
+                self.fake.count("throttled")
+                self.send(f"{tag} NO [THROTTLED] Request is throttled\r\n".encode())
+                continue
+
+            method = getattr(self, "do_" + command.replace(" ", "_"), None)
+            if method is None:
+                self.send(f"{tag} BAD unknown command {command}\r\n".encode())
+                continue
+            try:
+                if method(tag, _parse_args(arguments)) is False:
+                    return
+            except (ValueError, IndexError, KeyError, StopIteration) as e:
+                self.send(f"{tag} BAD {e!r}\r\n".encode())
+
+    def require_auth(self, tag: str) -> bool:
+        if not self.authenticated:
+            self.send(f"{tag} NO not authenticated\r\n".encode())
+        return self.authenticated
+
+    def require_folder(self, tag: str) -> bool:
+        if self.folder is None:
+            self.send(f"{tag} BAD no folder selected\r\n".encode())
+        return self.folder is not None
+
+    # --- commands, return False to close the connection ---
+
+    def do_CAPABILITY(self, tag: str, args: List[str]) -> None:
+        self.send(f"* CAPABILITY {CAPABILITIES}\r\n{tag} OK CAPABILITY\r\n".encode())
+
+    def do_NOOP(self, tag: str, args: List[str]) -> None:
+        self.send(f"{tag} OK NOOP\r\n".encode())
+
+    def do_LOGOUT(self, tag: str, args: List[str]) -> bool:
+        self.send(f"* BYE logging out\r\n{tag} OK LOGOUT\r\n".encode())
+        return False
+
+    def do_LOGIN(self, tag: str, args: List[str]) -> None:
+        if args[:2] == [self.fake.username, self.fake.password]:
+            self.authenticated = True
+            self.send(f"{tag} OK LOGIN completed\r\n".encode())
+        else:
+            self.send(
+                f"{tag} NO [AUTHENTICATIONFAILED] invalid credentials\r\n".encode()
+            )
+
+    def do_LIST(self, tag: str, args: List[str]) -> None:
+        if not self.require_auth(tag):
+            return
+        for folder in self.fake.folders:
+            self.send(b'* LIST (\\HasNoChildren) "/" ' + _string(folder) + b"\r\n")
+        self.send(f"{tag} OK LIST completed\r\n".encode())
+
+    def do_SELECT(self, tag: str, args: List[str]) -> None:
+        if not self.require_auth(tag):
+            return
+        folder = args[0]
+        if folder not in self.fake.folders:
+            self.folder = None
+            self.send(f"{tag} NO [NONEXISTENT] unknown folder\r\n".encode())
+            return
+        self.folder = folder
+        messages = self.fake.messages(folder)
+        uid_next = messages[-1].uid + 1 if messages else 1
+        self.send(
+            f"* {len(messages)} EXISTS\r\n* 0 RECENT\r\n"
+            f"* FLAGS (\\Seen \\Answered \\Flagged \\Deleted \\Draft)\r\n"
+            f"* OK [UIDVALIDITY 1] UIDs valid\r\n"
+            f"* OK [UIDNEXT {uid_next}] predicted next UID\r\n"
+            f"{tag} OK [READ-WRITE] SELECT completed\r\n".encode()
+        )
+
+    do_EXAMINE = do_SELECT
+
+    def do_SEARCH(self, tag: str, args: List[str], uid: bool = False) -> None:
+        if not self.require_auth(tag) or not self.require_folder(tag):
+            return
+        assert self.folder is not None
+        messages = self.fake.messages(self.folder)
+
+        if args and args[0].upper() == "CHARSET":
+            args = args[2:]
+        matches = list(enumerate(messages, start=1))
+        criteria = iter(args)
+        for criterion in criteria:
+            key = criterion.upper()
+            if key == "ALL":
+                continue
+            if key in ("SINCE", "BEFORE"):
+                day = datetime.strptime(next(criteria), "%d-%b-%Y").date()
+                if key == "SINCE":
+                    matches = [m for m in matches if m[1].date.date() >= day]
+                else:
+                    matches = [m for m in matches if m[1].date.date() < day]
+            elif key == "UID":
+                uids = _parse_set(next(criteria), [m.uid for m in messages])
+                matches = [m for m in matches if m[1].uid in uids]
+            elif re.fullmatch(r"[\d:,*]+", key):
+                seqs = _parse_set(key, list(range(1, len(messages) + 1)))
+                matches = [m for m in matches if m[0] in seqs]
+            else:
+                raise ValueError(f"unsupported search criterion {criterion}")
+
+        found = " ".join(str(msg.uid if uid else seq) for seq, msg in matches)
+        self.send(f"* SEARCH {found}\r\n{tag} OK SEARCH completed\r\n".encode())
+
+    def do_FETCH(self, tag: str, args: List[str], uid: bool = False) -> None:
+        if not self.require_auth(tag) or not self.require_folder(tag):
+            return
+        assert self.folder is not None
+        messages = self.fake.messages(self.folder)
+
+        items = [item.upper() for item in _ITEM_RE.findall(args[1])]
+        if uid and "UID" not in items:
+            items.insert(0, "UID")
+
+        if uid:
+            selected = _parse_set(args[0], [msg.uid for msg in messages])
+            numbered = [
+                (seq, msg)
+                for seq, msg in enumerate(messages, start=1)
+                if msg.uid in selected
+            ]
+        else:
+            seqs = _parse_set(args[0], list(range(1, len(messages) + 1)))
+            numbered = [(seq, messages[seq - 1]) for seq in seqs]
+
+        for seq, msg in numbered:
+            fields = [self.fetch_item(item, msg) for item in items]
+            self.send(b"* %d FETCH (%s)\r\n" % (seq, b" ".join(fields)))
+        self.send(f"{tag} OK FETCH completed\r\n".encode())
+
+    def fetch_item(self, item: str, msg: StoredMessage) -> bytes:
+        header, _, _ = msg.data.partition(b"\r\n\r\n")
+        header += b"\r\n\r\n"
+        key = item.replace(".PEEK", "")
+
+        if key == "UID":
+            return b"UID %d" % msg.uid
+        if key == "FLAGS":
+            return b"FLAGS (%s)" % " ".join(msg.flags).encode()
+        if key == "INTERNALDATE":
+            return b"INTERNALDATE " + _string(msg.date.strftime("%d-%b-%Y %H:%M:%S %z"))
+        if key == "RFC822.SIZE":
+            return b"RFC822.SIZE %d" % len(msg.data)
+        if key == "ENVELOPE":
+            return b"ENVELOPE " + envelope(msg.message)
+        if key in ("BODYSTRUCTURE", "BODY"):
+            return key.encode() + b" " + bodystructure(msg.message)
+        if key in ("RFC822", "BODY[]"):
+            return key.encode() + b" {%d}\r\n" % len(msg.data) + msg.data
+        if key == "RFC822.HEADER" or key.startswith("BODY[HEADER"):
+            name = "RFC822.HEADER" if key == "RFC822.HEADER" else key
+            return name.encode() + b" {%d}\r\n" % len(header) + header
+        raise ValueError(f"unsupported fetch item {item}")
+
+    def do_UID_FETCH(self, tag: str, args: List[str]) -> None:
+        self.do_FETCH(tag, args, uid=True)
+
+    def do_UID_SEARCH(self, tag: str, args: List[str]) -> None:
+        self.do_SEARCH(tag, args, uid=True)
+
+    def do_IDLE(self, tag: str, args: List[str]) -> None:
+        if not self.require_auth(tag) or not self.require_folder(tag):
+            return
+        assert self.folder is not None
+        known = len(self.fake.messages(self.folder))
+        self.send(b"+ idling\r\n")
+
+        sock = self.request
+        while True:
+            ready = sock.pending() or select.select([sock], [], [], 0.05)[0]
+            if ready:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                if line.strip().upper() == b"DONE":
+                    break
+                continue
+            count = len(self.fake.messages(self.folder))
+            if count != known:
+                self.send(f"* {count} EXISTS\r\n".encode())
+                known = count
+        self.send(f"{tag} OK IDLE terminated\r\n".encode())
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    fake: "FakeImapServer"
+
+
+class FakeImapServer:
+    """
+    Scriptable IMAP server running in a background thread.
+
+    Parameters
+    ----------
+    folders : dict
+        Folder name to list of raw messages.
+    faults : Faults
+        Random faults, can be changed while the server is running.
+    seed : int
+        Seed of the random fault generator.
+    """
+
+    def __init__(
+        self,
+        folders: Optional[Dict[str, List[bytes]]] = None,
+        username: str = "user",
+        password: str = "secret",
+        faults: Optional[Faults] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        seed: int = 0,
+    ) -> None:
+        self.username = username
+        self.password = password
+        self.faults = faults or Faults()
+        self.stats: Dict[str, int] = collections.Counter()
+
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._scripted: Dict[str, Deque[str]] = collections.defaultdict(
+            collections.deque
+        )
+        self._folders: Dict[str, List[StoredMessage]] = {}
+        self._uid = 0
+        for folder, messages in (folders or {"INBOX": []}).items():
+            self._folders[folder] = []
+            for data in messages:
+                self.append(folder, data)
+
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.certfile = generate_certificate(Path(self._tmpdir.name))
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.certfile)
+
+        self._server = _Server((host, port), _Handler)
+        self._server.socket = context.wrap_socket(
+            self._server.socket, server_side=True, do_handshake_on_connect=False
+        )
+        self._server.fake = self
+        self.host: str = host
+        self.port: int = self._server.server_address[1]
+        self._thread: Optional[threading.Thread] = None
+
+    # --- mailbox ---
+
+    @property
+    def folders(self) -> List[str]:
+        return list(self._folders)
+
+    def messages(self, folder: str) -> List[StoredMessage]:
+        with self._lock:
+            return list(self._folders[folder])
+
+    def append(self, folder: str, data: bytes) -> int:
+        """Add a message to a folder, returns its uid."""
+        msg = email.message_from_bytes(data)
+        try:
+            date = email.utils.parsedate_to_datetime(msg["Date"])
+        except (TypeError, ValueError):
+            date = datetime.now(timezone.utc)
+        with self._lock:
+            self._uid += 1
+            self._folders.setdefault(folder, []).append(
+                StoredMessage(self._uid, data, date)
+            )
+            return self._uid
+
+    # --- faults ---
+
+    def inject(self, command: str, fault: str, times: int = 1) -> None:
+        """
+        Script a fault for the next calls of a command.
+
+        fault is "throttle" or "disconnect", command e.g. "FETCH" or "UID FETCH".
+        """
+        if fault not in ("throttle", "disconnect"):
+            raise ValueError(f"Unknown fault: {fault}")
+        with self._lock:
+            self._scripted[command.upper()].extend([fault] * times)
+
+    def next_fault(self, command: str) -> Optional[str]:
+        """Fault to apply to a command, also applies latency."""
+        if self.faults.latency:
+            time.sleep(self.faults.latency)
+
+        with self._lock:
+            if self._scripted[command]:
+                return self._scripted[command].popleft()
+            if command in _NO_FAULT_COMMANDS:
+                return None
+            if self._random.random() < self.faults.disconnect_rate:
+                return "disconnect"
+            if self._random.random() < self.faults.throttle_rate:
+                return "throttle"
+        return None
+
+    def count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    # --- lifecycle ---
+
+    def client_context(self) -> ssl.SSLContext:
+        """SSL context for clients that trusts the server certificate."""
+        return ssl.create_default_context(cafile=str(self.certfile))
+
+    def start(self) -> "FakeImapServer":
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="fakeimap", daemon=True
+        )
+        self._thread.start()
+        log.info(f"Fake IMAP server listening on {self.host}:{self.port}")
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        self._tmpdir.cleanup()
+
+    def __enter__(self) -> "FakeImapServer":
+        return self.start()
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        tb: Optional[TracebackType],
+    ) -> None:
+        self.stop()
@@ -0,0 +1,162 @@
+"""
+Load test of the attachment download path
+
+Runs `download_attachments_from_folder` repeatedly over several connections in
+parallel and collects per-command latencies and errors.
+"""
+
+import logging
+import math
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from miltonmail import core
+
+log = logging.getLogger(__name__)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile, 0 for no values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+@dataclass
+class LoadTestReport:
+    """Latencies in seconds per IMAP command and per download run."""
+
+    concurrency: int
+    runs: int = 0
+    elapsed: float = 0.0
+    fetched_bytes: int = 0
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    errors: List[str] = field(default_factory=list)
+
+    def summary(self) -> List[str]:
+        """Report lines with tail latencies in ms."""
+        throughput = self.fetched_bytes / self.elapsed if self.elapsed else 0.0
+        lines = [
+            f"Runs: {self.runs} at concurrency {self.concurrency}"
+            f" in {self.elapsed:.1f}s",
+            f"Fetched: {self.fetched_bytes} bytes ({throughput / 1000:.1f} kB/s)",
+            f"{'operation':<12}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}",
+        ]
+        for name, values in sorted(self.latencies.items()):
+            stats = [percentile(values, pct) * 1000 for pct in (50, 95, 99, 100)]
+            lines.append(
+                f"{name:<12}{len(values):>7}" + "".join(f"{v:>9.1f}" for v in stats)
+            )
+        lines.append(f"Errors: {len(self.errors)}")
+        lines += [f"  {error}" for error in self.errors[:10]]
+        return lines
+
+
+class _TimedConnection:
+    """Records the latency of every IMAP command of a connection."""
+
+    def __init__(
+        self,
+        connection: core.Connection,
+        report: LoadTestReport,
+        lock: threading.Lock,
+    ) -> None:
+        self._connection = connection
+        self._report = report
+        self._lock = lock
+
+    def __getattr__(self, name: str) -> Any:
+        method = getattr(self._connection, name)
+        if name not in ("list", "select", "search", "fetch"):
+            return method
+
+        def timed(*args: Any) -> Any:
+            start = time.monotonic()
+            try:
+                return method(*args)
+            finally:
+                with self._lock:
+                    self._report.latencies[name.upper()].append(
+                        time.monotonic() - start
+                    )
+
+        return timed
+
+
+def run_load_test(
+    connect: Callable[[], core.Connection],
+    folder: str,
+    cutoff_date: str = "20220101",
+    concurrency: int = 4,
+    runs: int = 8,
+    output_dir: Optional[Path] = None,
+) -> LoadTestReport:
+    """
+    Download attachments from the folder `runs` times, `concurrency` at a time.
+
+    Every run uses its own connection and an empty output directory, so all
+    messages are fetched each time. Errors are recorded, not raised.
+
+    Parameters
+    ----------
+    connect : callable
+        Opens a new (logged in) connection.
+    folder : str
+        Folder to download from.
+    cutoff_date : str
+        The cutoff date in 'YYYYMMDD' format.
+    concurrency : int
+        Number of parallel connections.
+    runs : int
+        Total number of download runs.
+    output_dir : Path, optional
+        Where to save attachments, a temporary directory by default.
+    """
+    report = LoadTestReport(concurrency=concurrency)
+    lock = threading.Lock()
+
+    def run(number: int, root: Path) -> None:
+        start = time.monotonic()
+        connection = None
+        try:
+            connection = _TimedConnection(connect(), report, lock)
+            fetched = core.download_attachments_from_folder(
+                connection,  # type: ignore[arg-type]
+                folder,
+                output_dir=root / f"run_{number}",
+                cutoff_date=cutoff_date,
+            )
+        except Exception as e:
+            log.debug(f"Run {number} failed: {e!r}")
+            with lock:
+                report.errors.append(f"run {number}: {e!r}")
+            return
+        finally:
+            # do not leave sessions open at the server, also after a failure
+            if connection is not None:
+                try:
+                    connection.logout()
+                except Exception as e:
+                    log.debug(f"Run {number} logout failed: {e!r}")
+        with lock:
+            report.runs += 1
+            report.fetched_bytes += fetched
+            report.latencies["download"].append(time.monotonic() - start)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = output_dir or Path(tmpdir)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for number in range(runs):
+                executor.submit(run, number, root)
+        report.elapsed = time.monotonic() - start
+
+    return report
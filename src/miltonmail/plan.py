@@ -0,0 +1,244 @@
+"""
+Dry-run planning of attachment downloads
+
+Estimates what `download_attachments_from_folder` would transfer using only
+message metadata (RFC822.SIZE, ENVELOPE and BODYSTRUCTURE), no bodies are fetched.
+"""
+
+import email.utils
+import logging
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import unquote
+
+from miltonmail.core import Connection, decode_mime_words, format_filename, search_since
+from miltonmail.storage import AttachmentStore
+
+log = logging.getLogger(__name__)
+
+# number of messages per FETCH command
+BATCH_SIZE = 200
+
+_OPEN = object()
+_CLOSE = object()
+
+_LITERAL_RE = re.compile(rb"\{\d+\}$")
+_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+
+@dataclass
+class TransferPlan:
+    """Estimated size of an attachment download."""
+
+    messages: int = 0  # messages that will be fetched
+    message_bytes: int = 0  # total size of those messages
+    attachments: int = 0  # new attachments that will be saved
+    attachment_bytes: int = 0  # estimated decoded size of new attachments
+    existing: int = 0  # attachments already saved, will be skipped
+
+    def estimated_seconds(self, throughput: float) -> float:
+        """Estimated transfer time at the given throughput (bytes/s)."""
+        return self.message_bytes / throughput
+
+
+def format_size(num_bytes: float) -> str:
+    """Human readable size, e.g. 1.5 MB"""
+    for unit in ("B", "kB", "MB", "GB"):
+        if abs(num_bytes) < 1000:
+            return f"{num_bytes:.1f} {unit}" if unit != "B" else f"{num_bytes:.0f} B"
+        num_bytes /= 1000
+    return f"{num_bytes:.1f} TB"
+
+
+def _tokenize(text: bytes) -> Iterator[Any]:
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if match is None:
+            break
+        pos = match.end()
+        if match.group(1):
+            yield _OPEN
+        elif match.group(2):
+            yield _CLOSE
+        elif match.group(3) is not None:
+            yield re.sub(rb"\\(.)", rb"\1", match.group(3))
+        elif match.group(4):
+            atom = match.group(4).decode()
+            yield None if atom.upper() == "NIL" else atom
+
+
+def parse_fetch_response(msg_data: List[Any]) -> List[Any]:
+    """
+    Parse the data returned by imaplib FETCH into nested lists.
+
+    Atoms are returned as str, quoted strings and literals as bytes, NIL as None.
+    """
+    tokens: List[Any] = []
+    for item in msg_data:
+        if isinstance(item, tuple):
+            tokens.extend(_tokenize(_LITERAL_RE.sub(b"", item[0])))
+            tokens.append(item[1])
+        elif isinstance(item, bytes):
+            tokens.extend(_tokenize(item))
+
+    stack: List[List[Any]] = [[]]
+    for token in tokens:
+        if token is _OPEN:
+            stack.append([])
+        elif token is _CLOSE:
+            if len(stack) > 1:
+                completed = stack.pop()
+                stack[-1].append(completed)
+        else:
+            stack[-1].append(token)
+    return stack[0]
+
+
+def _text(value: Any) -> str:
+    if isinstance(value, bytes):
+        return value.decode(errors="replace")
+    return value if isinstance(value, str) else ""
+
+
+def _params(value: Any) -> Dict[str, str]:
+    if not isinstance(value, list):
+        return {}
+    params = {}
+    for key, val in zip(value[::2], value[1::2]):
+        params[_text(key).lower()] = _text(val)
+    return params
+
+
+def _param_filename(params: Dict[str, str], name: str) -> Optional[str]:
+    if name in params:
+        return params[name]
+    if f"{name}*" in params:
+        # RFC 2231 encoded, e.g. utf-8''na%C3%AFve.pdf
+        charset, _, value = email.utils.decode_rfc2231(params[f"{name}*"])
+        return unquote(value, encoding=charset or "utf-8", errors="replace")
+    return None
+
+
+def attachment_parts(body: List[Any]) -> Iterator[Tuple[str, int]]:
+    """
+    Walk a parsed BODYSTRUCTURE, yielding (filename, estimated size) of attachments.
+
+    Mirrors the parts `save_attachments_from_message` would save.
+    """
+    if not body:
+        return
+
+    if isinstance(body[0], list):  # multipart
+        for child in body:
+            if not isinstance(child, list):
+                break
+            yield from attachment_parts(child)
+        return
+
+    if len(body) < 7:
+        return
+
+    media_type = _text(body[0]).lower()
+    subtype = _text(body[1]).lower()
+    encoding = _text(body[5]).lower()
+    size = int(body[6]) if _text(body[6]).isdigit() else 0
+
+    # position of the extension fields depends on the media type
+    ext = 7
+    if media_type == "text":
+        ext = 8
+    elif media_type == "message" and subtype == "rfc822":
+        ext = 10
+        if isinstance(body[8], list):
+            yield from attachment_parts(body[8])
+
+    disposition = body[ext + 1] if len(body) > ext + 1 else None
+    if not isinstance(disposition, list) or not disposition:
+        return
+    if _text(disposition[0]).lower() != "attachment":
+        return
+
+    disposition_params = _params(disposition[1] if len(disposition) > 1 else None)
+    filename = _param_filename(disposition_params, "filename")
+    if filename is None:
+        filename = _param_filename(_params(body[2]), "name")
+    if not filename:
+        return
+
+    if encoding == "base64":
+        size = size * 3 // 4
+    yield decode_mime_words(filename), size
+
+
+def _envelope_date(envelope: Any) -> Optional[datetime]:
+    if not isinstance(envelope, list) or not envelope or envelope[0] is None:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(_text(envelope[0]))
+    except (TypeError, ValueError):
+        return None
+
+
+def plan_attachments_download(
+    connection: Connection,
+    folder: str,
+    output_dir: Path,
+    cutoff_date: str = "20220101",
+) -> TransferPlan:
+    """
+    Estimate the transfer of `download_attachments_from_folder` without fetching bodies.
+
+    Parameters
+    ----------
+    connection : imaplib.IMAP4_SSL or ImapSession
+        The IMAP connection object.
+    folder : str
+        The folder to plan the download for (e.g., "INBOX").
+    output_dir : Path
+        The directory where attachments would be saved.
+    cutoff_date : str
+        The cutoff date in 'YYYYMMDD' format.
+    """
+    message_ids = search_since(connection, folder, cutoff_date)
+
+    plan = TransferPlan(messages=len(message_ids))
+    store = AttachmentStore(output_dir)
+
+    for start in range(0, len(message_ids), BATCH_SIZE):
+        batch = ",".join(message_ids[start : start + BATCH_SIZE])
+        status, msg_data = connection.fetch(
+            batch, "(RFC822.SIZE ENVELOPE BODYSTRUCTURE)"
+        )
+        if status != "OK":
+            raise RuntimeError(f"Failed to fetch metadata in folder: {folder}")
+
+        response = parse_fetch_response(msg_data)
+        for items in response:
+            if not isinstance(items, list):
+                continue  # message sequence number
+            fields = {
+                _text(key).upper(): value for key, value in zip(items[::2], items[1::2])
+            }
+
+            size = _text(fields.get("RFC822.SIZE"))
+            plan.message_bytes += int(size) if size.isdigit() else 0
+
+            date = _envelope_date(fields.get("ENVELOPE"))
+            for filename, part_size in attachment_parts(
+                fields.get("BODYSTRUCTURE", [])
+            ):
+                name = format_filename(date, filename) if date else None
+                if name is not None and name in store.index(name):
+                    plan.existing += 1
+                    continue
+                if name is not None:
+                    store.index(name).add(name)
+                plan.attachments += 1
+                plan.attachment_bytes += part_size
+
+    log.info(f"Planned download from {folder}: {plan}")
+    return plan
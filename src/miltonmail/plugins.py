@@ -0,0 +1,195 @@
+"""
+Attachment post-processing plugins
+
+Plugins are plain callables ``plugin(filepath, payload)`` registered under the
+``miltonmail.attachment_plugins`` entry point group, e.g. in a plugin package::
+
+    [project.entry-points."miltonmail.attachment_plugins"]
+    unzip = "my_package.plugins:unzip"
+
+They receive the attachment bytes right after they are saved, so no second
+disk read is needed. Plugins run on a process pool, each call with its own timeout.
+At most two calls per worker are queued, `submit` blocks beyond that, so the
+payloads waiting for a worker do not pile up in memory.
+
+The timeout raises TimeoutError inside the plugin (SIGALRM, unix only). A plugin
+that catches it, or is stuck in C code, does not notice, so the parent also
+watches running calls: one still running well past the timeout is considered
+stuck, and its worker processes are killed and replaced. Other calls queued on
+the pool at that moment fail as well, the same happens when a plugin takes its
+worker process down (crash, os._exit).
+"""
+
+import logging
+import os
+import signal
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor
+from concurrent.futures import wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+from importlib.metadata import entry_points
+from pathlib import Path
+from types import FrameType, TracebackType
+from typing import Callable, Dict, List, Optional, Tuple, Type
+
+log = logging.getLogger(__name__)
+
+PLUGIN_GROUP = "miltonmail.attachment_plugins"
+
+AttachmentPlugin = Callable[[Path, bytes], None]
+
+# seconds a call may run past its timeout before its worker is killed
+STUCK_GRACE = 5.0
+
+
+def load_plugins(group: str = PLUGIN_GROUP) -> Dict[str, AttachmentPlugin]:
+    """Load attachment plugins registered under the entry point group."""
+    plugins = {}
+    for entry_point in entry_points(group=group):
+        try:
+            plugins[entry_point.name] = entry_point.load()
+        except Exception as e:
+            log.error(f"Failed to load plugin {entry_point.name}: {e}")
+            continue
+        log.debug(f"Loaded plugin: {entry_point.name}")
+    return plugins
+
+
+def _raise_timeout(signum: int, frame: Optional[FrameType]) -> None:
+    raise TimeoutError("Plugin timed out")
+
+
+def _run_plugin(
+    plugin: AttachmentPlugin, filepath: Path, payload: bytes, timeout: float
+) -> None:
+    """Run a plugin in a worker process, interrupting it after `timeout` seconds."""
+    # SIGALRM is unix-only, elsewhere plugins run without a hard limit
+    use_alarm = hasattr(signal, "setitimer")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        plugin(filepath, payload)
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class PluginPipeline:
+    """
+    Runs attachment plugins on a process pool.
+
+    Use as a context manager, on exit it waits for all scheduled plugin calls.
+    Plugin failures and timeouts are logged and do not stop the pipeline.
+    """
+
+    def __init__(
+        self,
+        plugins: Dict[str, AttachmentPlugin],
+        max_workers: Optional[int] = None,
+        timeout: float = 60.0,
+    ) -> None:
+        self.plugins = plugins
+        self.timeout = timeout
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = 2 * self.max_workers
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        self._pending: List[Tuple[str, Path, Future]] = []
+        # when a call was first seen running, futures are marked running once
+        # they are handed to the pool, possibly one call before they start
+        self._started: Dict[Future, float] = {}
+
+    def submit(self, filepath: Path, payload: bytes) -> None:
+        """Schedule all plugins for an attachment, blocks while the pool is full."""
+        self._collect(block=False)
+        for name, plugin in self.plugins.items():
+            while len(self._pending) >= self.max_pending:
+                self._collect(block=True)
+            try:
+                future = self._executor.submit(
+                    _run_plugin, plugin, filepath, payload, self.timeout
+                )
+            except BrokenProcessPool:
+                log.error("Plugin worker process died, restarting the plugin pool")
+                self._restart()
+                future = self._executor.submit(
+                    _run_plugin, plugin, filepath, payload, self.timeout
+                )
+            self._pending.append((name, filepath, future))
+
+    def wait(self) -> None:
+        """Wait for all scheduled plugin calls to finish."""
+        self._collect(block=False)
+        while self._pending:
+            wait_futures(
+                [future for _, _, future in self._pending], timeout=self.timeout
+            )
+            self._collect(block=False)
+
+    def _collect(self, block: bool) -> None:
+        if block:
+            wait_futures(
+                [future for _, _, future in self._pending],
+                timeout=self.timeout,
+                return_when=FIRST_COMPLETED,
+            )
+
+        now = time.monotonic()
+        # a call may wait for the one before it on the same worker
+        limit = 2 * self.timeout + STUCK_GRACE
+        stuck = broken = False
+        pending = []
+        for name, filepath, future in self._pending:
+            if not future.done():
+                if future.running():
+                    started = self._started.setdefault(future, now)
+                    if now - started > limit:
+                        log.error(f"Plugin {name} is stuck on {filepath.name}")
+                        stuck = True
+                pending.append((name, filepath, future))
+                continue
+            broken |= isinstance(future.exception(), BrokenProcessPool)
+            self._report(name, filepath, future)
+        self._pending = pending
+
+        if stuck:
+            # the executor has no public way to stop a running call
+            for process in list((self._executor._processes or {}).values()):
+                process.terminate()
+        if stuck or broken:
+            self._restart()
+
+    def _report(self, name: str, filepath: Path, future: Future) -> None:
+        self._started.pop(future, None)
+        exc = None if future.cancelled() else future.exception()
+        if future.cancelled():
+            log.error(f"Plugin {name} cancelled on {filepath.name}")
+        elif isinstance(exc, TimeoutError):
+            log.error(f"Plugin {name} timed out on {filepath.name}")
+        elif exc is not None:
+            log.error(f"Plugin {name} failed on {filepath.name}: {exc}")
+        else:
+            log.debug(f"Plugin {name} processed {filepath.name}")
+
+    def _restart(self) -> None:
+        """Replace a broken or stuck pool, its remaining calls are lost."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for name, filepath, future in self._pending:
+            self._report(name, filepath, future)
+        self._pending = []
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+    def close(self) -> None:
+        self.wait()
+        self._executor.shutdown()
+
+    def __enter__(self) -> "PluginPipeline":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        tb: Optional[TracebackType],
+    ) -> None:
+        self.close()
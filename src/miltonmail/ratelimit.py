@@ -0,0 +1,152 @@
+"""
+Client side rate limiting for IMAP commands
+
+A token bucket paces the commands once the server has throttled us, its refill
+rate adapts AIMD-style: it grows additively on every successful command and is
+cut multiplicatively whenever the server throttles us. An optional maximum rate
+caps it and paces commands from the start.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Optional
+
+log = logging.getLogger(__name__)
+
+# response markers used by providers (Gmail, O365) to signal throttling
+THROTTLE_MARKERS = ("THROTTLED", "[LIMIT]", "[UNAVAILABLE]", "TOO MANY", "EXCEEDED")
+
+# commands the sending rate is measured over
+RATE_WINDOW = 20
+# commands per second to start pacing at when the sending rate is unknown
+INITIAL_RATE = 5.0
+
+
+def is_throttled(response: object) -> bool:
+    """Check if an IMAP response or error text signals throttling."""
+    if isinstance(response, (list, tuple)):
+        return any(is_throttled(item) for item in response)
+    if isinstance(response, bytes):
+        response = response.decode(errors="replace")
+    if not isinstance(response, str):
+        return False
+    text = response.upper()
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+
+class RateLimiter:
+    """
+    Token bucket with an AIMD-adapted refill rate.
+
+    Without `max_rate` commands are not paced until the server first throttles
+    them. Pacing then starts below the rate commands were actually sent at.
+    The rate grows additively on every successful command, probing above the
+    achieved rate for the highest rate the server sustains, and is cut
+    multiplicatively whenever the server throttles again.
+
+    Parameters
+    ----------
+    max_rate : float, optional
+        Hard cap in commands per second, commands are paced from the start.
+    burst : int
+        Bucket size, number of commands that may be issued back to back.
+    min_rate : float
+        Lower bound for the rate after repeated throttling.
+    increase : float
+        Rate added after every successful command.
+    decrease : float
+        Factor the rate is multiplied with when throttled.
+
+    Thread-safe, so the connections of an account can share one limiter.
+    """
+
+    def __init__(
+        self,
+        max_rate: Optional[float] = None,
+        burst: int = 1,
+        min_rate: float = 0.1,
+        increase: float = 0.1,
+        decrease: float = 0.5,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        if (max_rate is not None and max_rate <= 0) or burst < 1:
+            raise ValueError("max_rate must be positive and burst at least 1")
+
+        self.max_rate = max_rate
+        # None while commands are not paced
+        self.rate: Optional[float] = max_rate
+        self.burst = burst
+        self.min_rate = min(min_rate, max_rate) if max_rate else min_rate
+        self.increase = increase
+        self.decrease = decrease
+
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._sent: Deque[float] = deque(maxlen=RATE_WINDOW)
+        self._lock = threading.Lock()
+
+    def measured_rate(self) -> Optional[float]:
+        """Rate of the recent commands in commands per second, None if unknown."""
+        if len(self._sent) < 2:
+            return None
+        span = self._sent[-1] - self._sent[0]
+        return (len(self._sent) - 1) / span if span > 0 else None
+
+    def _refill(self) -> None:
+        now = self._clock()
+        if self.rate is not None:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+        self._updated = now
+
+    def acquire(self) -> None:
+        """Block until a command may be issued."""
+        # the token is reserved under the lock, the wait for it happens outside
+        with self._lock:
+            self._refill()
+            delay = 0.0
+            if self.rate is not None:
+                self._tokens -= 1
+                if self._tokens < 0:
+                    delay = -self._tokens / self.rate
+            self._sent.append(self._updated + delay)
+        if delay:
+            self._sleep(delay)
+
+    def on_success(self) -> None:
+        """Additive increase of the rate."""
+        with self._lock:
+            if self.rate is None:
+                return
+            rate = self.rate + self.increase
+            measured = self.measured_rate()
+            if measured is not None:
+                # probe above the achieved rate, not arbitrarily far
+                rate = min(rate, max(self.rate, 2 * measured))
+            if self.max_rate is not None:
+                rate = min(rate, self.max_rate)
+            self.rate = rate
+
+    def on_throttle(self) -> None:
+        """Multiplicative decrease of the rate, also drains the bucket."""
+        with self._lock:
+            self._refill()
+            measured = self.measured_rate()
+            if self.rate is None:
+                rate = measured or INITIAL_RATE
+            else:
+                rate = min(self.rate, measured) if measured else self.rate
+            self.rate = max(self.min_rate, rate * self.decrease)
+            self._tokens = min(self._tokens, 0.0)
+        log.warning(f"Throttled by server, reducing rate to {self.rate:.2f} cmd/s")
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Exponential backoff delay for the given retry attempt (0-based)."""
+    return min(cap, base * 2**attempt)
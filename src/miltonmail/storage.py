@@ -0,0 +1,439 @@
+"""
+Local attachment storage
+
+Attachments are stored in month shards (YYYY/MM) derived from the date prefix
+of their filename. Old shards can be packed into archives, their file names stay
+known through a per-shard index so they are not downloaded again.
+
+    attachments/
+        2024/10/20241007_invoice.pdf
+        .index/2024-10.jsonl
+        archive/2022-03_1.zip
+        archive/2022-03.json
+
+In-memory indexes of the shards keep existence checks off the (possibly
+networked) filesystem. Size and digest of saved files are appended to a
+per-shard sidecar index, so name collisions are resolved without reading
+the files again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tarfile
+import zipfile
+from dataclasses import dataclass
+from datetime import date
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+log = logging.getLogger(__name__)
+
+# what to do when an attachment name is already taken by a different file
+# skip: keep the existing file, number: save as name_1.ext, name_2.ext ...
+# hash: save as name_<content hash>.ext
+COLLISION_POLICIES = ("skip", "number", "hash")
+
+ARCHIVE_FORMATS = {"zip": ".zip", "tar": ".tar.gz"}
+ARCHIVE_DIR = "archive"
+INDEX_DIR = ".index"
+
+_DATED_RE = re.compile(r"^(\d{4})(\d{2})\d{2}_")
+_SHARD_RE = re.compile(r"^\d{4}/\d{2}$")
+
+
+def shard_of(filename: str) -> Optional[str]:
+    """Month shard (YYYY/MM) of an attachment filename, None for undated names."""
+    match = _DATED_RE.match(filename)
+    return f"{match[1]}/{match[2]}" if match else None
+
+
+def _months(shard: str, today: date) -> int:
+    """Age of a shard in months."""
+    year, month = shard.split("/")
+    return (today.year - int(year)) * 12 + today.month - int(month)
+
+
+class DirectoryIndex:
+    """
+    Index of the files in a directory.
+
+    The directory is scanned once with os.scandir, afterwards the index is kept
+    up to date with `add`, so lookups need no system calls.
+    File sizes and digests not in the sidecar index are only read when needed
+    to resolve a collision, and then added to the sidecar.
+    """
+
+    def __init__(self, path: Path, sidecar: Optional[Path] = None) -> None:
+        self.path = path
+        self.sidecar = sidecar
+        self._sizes: Dict[str, Optional[int]] = {}
+        self._digests: Dict[str, str] = {}
+
+        if path.is_dir():
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        self._sizes[entry.name] = None
+        self._load_sidecar()
+        log.debug(f"Indexed {len(self._sizes)} files in {path}")
+
+    def _load_sidecar(self) -> None:
+        if self.sidecar is None or not self.sidecar.exists():
+            return
+        with open(self.sidecar, "r", encoding="utf8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # partly written line, e.g. after a crash
+                    continue
+                # entries of files removed since are ignored
+                if entry["name"] in self._sizes:
+                    self._sizes[entry["name"]] = entry["size"]
+                    self._digests[entry["name"]] = entry["sha256"]
+
+    def _append_sidecar(self, name: str, size: int, digest: str) -> None:
+        if self.sidecar is None:
+            return
+        self.sidecar.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.sidecar, "a", encoding="utf8") as file:
+            file.write(json.dumps({"name": name, "size": size, "sha256": digest}))
+            file.write("\n")
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._sizes
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._sizes)
+
+    def add(
+        self,
+        name: str,
+        size: Optional[int] = None,
+        digest: Optional[str] = None,
+        persist: bool = True,
+    ) -> None:
+        """
+        Register a file written to the directory.
+
+        With size and digest given, they are also saved to the sidecar index,
+        unless `persist` is False.
+        """
+        self._sizes[name] = size
+        if digest is None:
+            self._digests.pop(name, None)
+            return
+        self._digests[name] = digest
+        if persist and size is not None:
+            self._append_sidecar(name, size, digest)
+
+    def size(self, name: str) -> int:
+        """Size of an indexed file."""
+        size = self._sizes[name]
+        if size is None:
+            size = (self.path / name).stat().st_size
+            self._sizes[name] = size
+        return size
+
+    def digest(self, name: str) -> Optional[str]:
+        """SHA-256 of an indexed file, None if it is no longer on disk."""
+        if name not in self._digests:
+            path = self.path / name
+            if not path.is_file():
+                return None
+            self._digests[name] = file_digest(path)
+            self._append_sidecar(name, self.size(name), self._digests[name])
+        return self._digests[name]
+
+    def same_content(self, name: str, payload: bytes) -> bool:
+        """Check if an indexed file holds the payload."""
+        if self.size(name) != len(payload):
+            return False
+        digest = self.digest(name)
+        if digest is None:
+            # archived without a digest, the size is all that is known
+            return True
+        return digest == hashlib.sha256(payload).hexdigest()
+
+
+def file_digest(path: Path) -> str:
+    """SHA-256 of a file."""
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def resolve_filename(
+    index: DirectoryIndex, filename: str, payload: bytes, policy: str = "skip"
+) -> Optional[str]:
+    """
+    Get the name to save an attachment under, None if it is already saved.
+
+    An existing file with the same content is considered to be the same
+    attachment, so repeated downloads do not create copies.
+    """
+    if policy not in COLLISION_POLICIES:
+        raise ValueError(f"Unknown collision policy: {policy}")
+
+    if filename not in index:
+        return filename
+    if policy == "skip" or index.same_content(filename, payload):
+        return None
+
+    stem, suffix = os.path.splitext(filename)
+
+    if policy == "hash":
+        digest = hashlib.sha256(payload).hexdigest()[:8]
+        candidate = f"{stem}_{digest}{suffix}"
+        return None if candidate in index else candidate
+
+    number = 1
+    while True:
+        candidate = f"{stem}_{number}{suffix}"
+        if candidate not in index:
+            return candidate
+        if index.same_content(candidate, payload):
+            return None
+        number += 1
+
+
+@dataclass
+class CompactionReport:
+    shards_archived: int = 0
+    files_archived: int = 0
+    files_expired: int = 0
+
+
+class AttachmentStore:
+    """
+    Attachment directory sharded by month.
+
+    Shard indexes are built on first use and include the names of archived
+    and expired files, so those count as saved.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.archive_dir = root / ARCHIVE_DIR
+        self._indexes: Dict[str, DirectoryIndex] = {}
+
+    def directory(self, filename: str) -> Path:
+        """Directory an attachment is stored in."""
+        shard = shard_of(filename)
+        return self.root / shard if shard else self.root
+
+    def index(self, filename: str) -> DirectoryIndex:
+        """Index of the shard an attachment belongs to."""
+        return self._index(shard_of(filename) or "")
+
+    def _index(self, shard: str) -> DirectoryIndex:
+        if shard not in self._indexes:
+            index = DirectoryIndex(self.root / shard, self._sidecar(shard))
+            for name, entry in self._load_archive_index(shard).items():
+                index.add(name, entry["size"], entry.get("sha256"), persist=False)
+            if shard:
+                # files of the flat layout, until they are migrated
+                flat = self._index("")
+                for name in flat:
+                    if shard_of(name) == shard and name not in index:
+                        index.add(name, flat.size(name))
+            self._indexes[shard] = index
+        return self._indexes[shard]
+
+    def shards(self) -> List[str]:
+        """Existing shard directories, oldest first."""
+        if not self.root.is_dir():
+            return []
+        return sorted(
+            path.relative_to(self.root).as_posix()
+            for path in self.root.glob("*/*")
+            if path.is_dir() and _SHARD_RE.match(path.relative_to(self.root).as_posix())
+        )
+
+    def migrate(self) -> int:
+        """Move attachments saved in the flat layout into month shards."""
+        if not self.root.is_dir():
+            return 0
+        with os.scandir(self.root) as entries:
+            names = [entry.name for entry in entries if entry.is_file()]
+
+        moved = 0
+        for name in names:
+            shard = shard_of(name)
+            if shard is None:
+                continue
+            target = self.root / shard / name
+            if target.exists():
+                log.warning(f"Not migrating {name}, already exists in {shard}")
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            (self.root / name).rename(target)
+            moved += 1
+
+        if moved:
+            log.info(f"Moved {moved} attachments into month shards in {self.root}")
+            self._indexes.clear()
+        return moved
+
+    def compact(
+        self,
+        compact_after_months: int = 12,
+        retention_months: int = 0,
+        fmt: str = "zip",
+        today: Optional[date] = None,
+    ) -> CompactionReport:
+        """
+        Pack old shards into archives and drop data past retention.
+
+        Parameters
+        ----------
+        compact_after_months : int
+            Shards at least this many months old are archived, 0 disables.
+        retention_months : int
+            Files and archives at least this many months old are deleted,
+            0 keeps everything. Their names are kept in the shard index.
+        fmt : str
+            Archive format, one of ARCHIVE_FORMATS.
+        today : date, optional
+            Reference date for the shard age, today by default.
+        """
+        if fmt not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format: {fmt}")
+        today = today or date.today()
+        report = CompactionReport()
+
+        for shard in self.shards():
+            age = _months(shard, today)
+            if retention_months and age >= retention_months:
+                report.files_expired += self._archive_shard(shard, None)
+            elif compact_after_months and age >= compact_after_months:
+                report.files_archived += self._archive_shard(shard, fmt)
+                report.shards_archived += 1
+
+        if retention_months:
+            for shard in self._archived_shards():
+                if _months(shard, today) >= retention_months:
+                    report.files_expired += self._expire_archives(shard)
+
+        self._indexes.clear()
+        return report
+
+    def _sidecar(self, shard: str) -> Path:
+        return self.root / INDEX_DIR / f"{shard.replace('/', '-') or 'undated'}.jsonl"
+
+    # --- archive index, archive/YYYY-MM.json ---
+
+    def _index_file(self, shard: str) -> Path:
+        return self.archive_dir / f"{shard.replace('/', '-')}.json"
+
+    def _load_archive_index(self, shard: str) -> Dict[str, Any]:
+        index_file = self._index_file(shard) if shard else None
+        if index_file is None or not index_file.exists():
+            return {}
+        with open(index_file, "r", encoding="utf8") as file:
+            return json.load(file)["files"]
+
+    def _save_archive_index(self, shard: str, files: Dict[str, Any]) -> None:
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        index_file = self._index_file(shard)
+        tmp_file = index_file.with_suffix(".tmp")
+        with open(tmp_file, "w", encoding="utf8") as file:
+            json.dump({"files": files}, file, indent=4)
+        tmp_file.replace(index_file)
+
+    def _archived_shards(self) -> List[str]:
+        if not self.archive_dir.is_dir():
+            return []
+        return sorted(
+            path.stem.replace("-", "/") for path in self.archive_dir.glob("*-*.json")
+        )
+
+    def _archive_shard(self, shard: str, fmt: Optional[str]) -> int:
+        """Move the files of a shard into a new archive, delete them if fmt is None."""
+        directory = self.root / shard
+        files = sorted(path for path in directory.iterdir() if path.is_file())
+        entries = self._load_archive_index(shard)
+        index = DirectoryIndex(directory, self._sidecar(shard))
+
+        archive_name = None
+        if fmt is not None and files:
+            archive_name = self._write_archive(shard, files, fmt)
+        for path in files:
+            entries[path.name] = {
+                "size": index.size(path.name),
+                "sha256": index.digest(path.name),
+                "archive": archive_name,
+            }
+
+        # the index is written before the files are removed
+        self._save_archive_index(shard, entries)
+        for path in files:
+            path.unlink()
+        self._sidecar(shard).unlink(missing_ok=True)
+        for empty in (directory, directory.parent):
+            if not any(empty.iterdir()):
+                empty.rmdir()
+
+        log.info(f"{'Archived' if fmt else 'Expired'} {len(files)} files of {shard}")
+        return len(files)
+
+    def _write_archive(self, shard: str, files: List[Path], fmt: str) -> str:
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        prefix = shard.replace("/", "-")
+        number = 1
+        while (self.archive_dir / f"{prefix}_{number}{ARCHIVE_FORMATS[fmt]}").exists():
+            number += 1
+        archive_name = f"{prefix}_{number}{ARCHIVE_FORMATS[fmt]}"
+        tmp_file = self.archive_dir / f"{archive_name}.tmp"
+
+        if fmt == "zip":
+            with zipfile.ZipFile(tmp_file, "w", zipfile.ZIP_DEFLATED) as archive:
+                for path in files:
+                    archive.write(path, arcname=path.name)
+        else:
+            with tarfile.open(tmp_file, "w:gz") as tar:
+                for path in files:
+                    tar.add(path, arcname=path.name)
+
+        tmp_file.replace(self.archive_dir / archive_name)
+        return archive_name
+
+    def _expire_archives(self, shard: str) -> int:
+        entries = self._load_archive_index(shard)
+        archives = {entry["archive"] for entry in entries.values() if entry["archive"]}
+        if not archives:
+            return 0
+
+        expired = 0
+        for entry in entries.values():
+            if entry["archive"]:
+                entry["archive"] = None
+                expired += 1
+        self._save_archive_index(shard, entries)
+        for archive_name in archives:
+            (self.archive_dir / archive_name).unlink(missing_ok=True)
+
+        log.info(f"Expired {len(archives)} archives of {shard}")
+        return expired
+
+
+_stores: Dict[Path, AttachmentStore] = {}
+
+
+def shared_store(root: Path) -> AttachmentStore:
+    """
+    Store of a directory, shared within the process.
+
+    Its shard indexes are built once, so saving message by message does not
+    scan the directory on every call. All writers of the directory in this
+    process must use it, otherwise its indexes go stale.
+    """
+    key = root.resolve()
+    if key not in _stores:
+        _stores[key] = AttachmentStore(root)
+    return _stores[key]
@@ -0,0 +1,25 @@
+from typing import Iterator
+
+import pytest
+
+from miltonmail import core, fakeimap
+
+
+@pytest.fixture
+def imap_server() -> Iterator[fakeimap.FakeImapServer]:
+    """Stand-in IMAP server with 5 messages in INBOX, one attachment each."""
+    with fakeimap.FakeImapServer({"INBOX": fakeimap.generate_messages(5)}) as server:
+        yield server
+
+
+@pytest.fixture
+def imap_session(imap_server: fakeimap.FakeImapServer) -> core.ImapSession:
+    """Session logged in to the stand-in server, retrying without delay."""
+    return core.ImapSession(
+        imap_server.host,
+        imap_server.username,
+        imap_server.password,
+        imap_server.port,
+        backoff=0.0,
+        ssl_context=imap_server.client_context(),
+    )
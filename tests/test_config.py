@@ -122,3 +122,14 @@ def test_saving_loading_with_salt() -> None:
 
     assert loaded_account.name == "Salted Account"
     assert loaded_account.salt == test_account.salt
+
+
+def test_throughput() -> None:
+    """Test saving and loading the measured download throughput."""
+
+    config.DB_PATH = Path("/tmp/milton")
+
+    assert config.get_throughput("No Stats") is None
+
+    config.save_throughput("Test Account", 1234.5)
+    assert config.get_throughput("Test Account") == 1234.5
@@ -0,0 +1,117 @@
+import email
+import socket
+import ssl
+from pathlib import Path
+
+import pytest
+
+from miltonmail import core, fakeimap, plan
+
+
+def test_login(imap_server: fakeimap.FakeImapServer) -> None:
+    context = imap_server.client_context()
+    with pytest.raises(ConnectionError):
+        core.login_to_imap(
+            imap_server.host, "user", "wrong", imap_server.port, ssl_context=context
+        )
+
+    # certificate is verified with the context
+    with pytest.raises(ssl.SSLError):
+        core.login_to_imap(
+            imap_server.host,
+            "user",
+            "secret",
+            imap_server.port,
+            ssl_context=ssl.create_default_context(),
+        )
+
+
+def test_download(imap_session: core.ImapSession, tmp_path: Path) -> None:
+    transfer = plan.plan_attachments_download(
+        imap_session, "INBOX", tmp_path, "20240102"
+    )
+    assert transfer.messages == 4
+    assert transfer.attachments == 4
+
+    core.download_attachments_from_folder(
+        imap_session, "INBOX", tmp_path, cutoff_date="20240102"
+    )
+    saved = sorted((tmp_path / "2024" / "01").iterdir())
+    assert [path.name for path in saved] == [
+        f"2024010{i + 1}_attachment_{i}.bin" for i in range(1, 5)
+    ]
+    assert all(path.stat().st_size == 10_000 for path in saved)
+
+
+def test_uid_commands(
+    imap_server: fakeimap.FakeImapServer, imap_session: core.ImapSession
+) -> None:
+    imap_server.append("INBOX", fakeimap.generate_messages(1)[0])
+    conn = imap_session.connection
+    conn.select("INBOX")
+
+    status, data = conn.uid("SEARCH", "UID", "5:*")
+    assert status == "OK"
+    assert data == [b"5 6"]
+
+    status, data = conn.uid("FETCH", "6", "(RFC822.SIZE)")
+    assert status == "OK"
+    assert data[0].startswith(b"6 (UID 6 RFC822.SIZE ")
+
+
+def test_faults(
+    imap_server: fakeimap.FakeImapServer, imap_session: core.ImapSession
+) -> None:
+    core.select_folder(imap_session, "INBOX")
+
+    imap_server.inject("FETCH", "throttle", times=2)
+    imap_server.inject("FETCH", "disconnect")
+    status, _ = imap_session.fetch("1", "(RFC822.SIZE)")
+
+    assert status == "OK"
+    assert imap_server.stats["throttled"] == 2
+    assert imap_server.stats["disconnected"] == 1
+    assert imap_server.stats["LOGIN"] == 2
+
+    # a throttled re-select after reconnecting is retried as well
+    imap_server.inject("FETCH", "disconnect")
+    imap_server.inject("SELECT", "throttle")
+    status, _ = imap_session.fetch("1", "(RFC822.SIZE)")
+    assert status == "OK"
+    assert imap_server.stats["LOGIN"] == 4
+
+    imap_server.faults.throttle_rate = 1.0
+    imap_session.max_retries = 1
+    status, data = imap_session.fetch("1", "(RFC822.SIZE)")
+    assert status == "NO"
+    assert b"[THROTTLED]" in data[0]
+
+
+def test_idle(imap_server: fakeimap.FakeImapServer) -> None:
+    context = imap_server.client_context()
+    raw = socket.create_connection((imap_server.host, imap_server.port))
+    with context.wrap_socket(raw, server_hostname=imap_server.host) as sock:
+        reader = sock.makefile("rb")
+        reader.readline()  # greeting
+        sock.sendall(b"a1 LOGIN user secret\r\na2 SELECT INBOX\r\n")
+        while not reader.readline().startswith(b"a2 OK"):
+            pass
+
+        sock.sendall(b"a3 IDLE\r\n")
+        assert reader.readline().startswith(b"+")
+        imap_server.append("INBOX", fakeimap.generate_messages(1)[0])
+        assert reader.readline() == b"* 6 EXISTS\r\n"
+
+        sock.sendall(b"DONE\r\n")
+        assert reader.readline().startswith(b"a3 OK")
+
+
+def test_bodystructure() -> None:
+    data = fakeimap.generate_messages(1)[0]
+    structure = fakeimap.bodystructure(email.message_from_bytes(data))
+    (body,) = plan.parse_fetch_response([structure])
+
+    ((name, size),) = plan.attachment_parts(body)
+    assert name == "attachment_0.bin"
+    # estimated from the base64 size, including line breaks
+    assert 10_000 <= size < 10_500
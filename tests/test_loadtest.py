@@ -0,0 +1,58 @@
+from miltonmail import core, fakeimap, loadtest
+
+
+def test_percentile() -> None:
+    values = [float(v) for v in range(1, 101)]
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile(values, 100) == 100
+    assert loadtest.percentile([], 50) == 0
+
+
+def test_run_load_test(imap_server: fakeimap.FakeImapServer) -> None:
+    imap_server.faults.throttle_rate = 0.1
+
+    def connect() -> core.ImapSession:
+        return core.ImapSession(
+            imap_server.host,
+            imap_server.username,
+            imap_server.password,
+            imap_server.port,
+            backoff=0.0,
+            ssl_context=imap_server.client_context(),
+        )
+
+    report = loadtest.run_load_test(connect, "INBOX", "20240101", concurrency=3, runs=6)
+
+    assert report.runs == 6
+    assert not report.errors
+    assert len(report.latencies["FETCH"]) == 6 * 5
+    assert len(report.latencies["download"]) == 6
+    assert report.summary()[-1] == "Errors: 0"
+
+
+def test_load_test_errors(imap_server: fakeimap.FakeImapServer) -> None:
+    def connect() -> core.ImapSession:
+        return core.ImapSession(
+            imap_server.host,
+            "user",
+            "wrong",
+            imap_server.port,
+            ssl_context=imap_server.client_context(),
+        )
+
+    report = loadtest.run_load_test(connect, "INBOX", concurrency=2, runs=2)
+
+    assert report.runs == 0
+    assert len(report.errors) == 2
+
+
+def test_load_test_logout_after_error(
+    imap_server: fakeimap.FakeImapServer, imap_session: core.ImapSession
+) -> None:
+    report = loadtest.run_load_test(
+        lambda: imap_session, "NoSuchFolder", concurrency=1, runs=1
+    )
+
+    assert len(report.errors) == 1
+    assert imap_server.stats["LOGOUT"] == 1
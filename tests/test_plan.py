@@ -0,0 +1,88 @@
+from pathlib import Path
+from typing import Any, List, Tuple
+
+import pytest
+
+from miltonmail import plan
+
+ENVELOPE = (
+    b'("Mon, 07 Oct 2024 10:00:00 +0000" {11}',
+    b"Hello world",
+)
+BODYSTRUCTURE = (
+    b' NIL NIL NIL NIL NIL NIL NIL "<id@test>") BODYSTRUCTURE (("text" "plain"'
+    b' ("charset" "utf-8") NIL NIL "7bit" 4 1 NIL NIL NIL NIL)'
+    b' ("application" "pdf" ("name" "invoice.pdf") NIL NIL "base64" 400 NIL'
+    b' ("attachment" ("filename" "invoice.pdf")) NIL NIL)'
+    b' ("image" "png" NIL NIL NIL "base64" 80 NIL ("attachment"'
+    b' ("filename*" "utf-8\'\'my%20logo.png")) NIL NIL)'
+    b' "mixed" ("boundary" "xyz") NIL NIL NIL))'
+)
+
+
+def fetch_response(seq: int) -> List[Any]:
+    return [
+        (f"{seq} (RFC822.SIZE 1234 ENVELOPE ".encode() + ENVELOPE[0], ENVELOPE[1]),
+        BODYSTRUCTURE,
+    ]
+
+
+class FakeConnection:
+    def select(self, mailbox: str) -> Tuple[str, List[Any]]:
+        return "OK", [b"2"]
+
+    def search(self, charset: Any, *criteria: str) -> Tuple[str, List[Any]]:
+        return "OK", [b"1 2"]
+
+    def fetch(self, message_set: str, message_parts: str) -> Tuple[str, List[Any]]:
+        assert "RFC822)" not in message_parts
+        data: List[Any] = []
+        for seq in message_set.split(","):
+            data.extend(fetch_response(int(seq)))
+        return "OK", data
+
+
+def test_parse_fetch_response() -> None:
+    seq, items = plan.parse_fetch_response(fetch_response(1))
+
+    assert seq == "1"
+    assert items[:2] == ["RFC822.SIZE", "1234"]
+    envelope = items[3]
+    assert envelope[0] == b"Mon, 07 Oct 2024 10:00:00 +0000"
+    assert envelope[1] == b"Hello world"
+    assert envelope[2] is None
+
+
+def test_attachment_parts() -> None:
+    _, items = plan.parse_fetch_response(fetch_response(1))
+    parts = list(plan.attachment_parts(items[5]))
+
+    assert parts == [("invoice.pdf", 300), ("my logo.png", 60)]
+
+
+@pytest.mark.parametrize("directory", ["2024/10", "."])
+def test_plan_attachments_download(tmp_path: Path, directory: str) -> None:
+    # saved in a month shard or, not migrated yet, in the flat layout
+    existing = tmp_path / directory / "20241007_invoice.pdf"
+    existing.parent.mkdir(parents=True, exist_ok=True)
+    existing.write_bytes(b"")
+
+    transfer = plan.plan_attachments_download(
+        FakeConnection(), "INBOX", tmp_path, "20240101"
+    )
+
+    assert transfer.messages == 2
+    assert transfer.message_bytes == 2 * 1234
+    # logo is new once, invoice exists and second copies have the same name
+    assert transfer.attachments == 1
+    assert transfer.attachment_bytes == 60
+    assert transfer.existing == 3
+    assert transfer.estimated_seconds(1234) == 2
+    # planning does not touch the directory
+    assert existing.exists()
+
+
+def test_format_size() -> None:
+    assert plan.format_size(999) == "999 B"
+    assert plan.format_size(1500) == "1.5 kB"
+    assert plan.format_size(2_500_000) == "2.5 MB"
@@ -0,0 +1,109 @@
+import os
+import time
+from email.message import EmailMessage
+from pathlib import Path
+
+import pytest
+
+from miltonmail import core, plugins
+
+
+def write_size(filepath: Path, payload: bytes) -> None:
+    """test plugin, writes payload size next to the attachment"""
+    filepath.with_suffix(".size").write_text(str(len(payload)))
+
+
+def slow_size(filepath: Path, payload: bytes) -> None:
+    time.sleep(0.05)
+    write_size(filepath, payload)
+
+
+def hang(filepath: Path, payload: bytes) -> None:
+    time.sleep(10)
+
+
+def crash(filepath: Path, payload: bytes) -> None:
+    os._exit(1)
+
+
+def stubborn(filepath: Path, payload: bytes) -> None:
+    """ignores the timeout"""
+    while True:
+        try:
+            time.sleep(10)
+        except Exception:
+            pass
+
+
+def make_message() -> EmailMessage:
+    msg = EmailMessage()
+    msg["Subject"] = "test"
+    msg["Date"] = "Mon, 07 Oct 2024 10:00:00 +0000"
+    msg.set_content("body")
+    msg.add_attachment(
+        b"hello", maintype="application", subtype="octet-stream", filename="a b.bin"
+    )
+    return msg
+
+
+def test_load_plugins_empty_group() -> None:
+    assert plugins.load_plugins("miltonmail.no_such_group") == {}
+
+
+def test_pipeline_runs_plugins(tmp_path: Path) -> None:
+    with plugins.PluginPipeline({"size": write_size}, max_workers=1) as pipeline:
+        core.save_attachments_from_message(make_message(), tmp_path, pipeline)
+
+    shard = tmp_path / "2024" / "10"
+    assert (shard / "20241007_a_b.bin").read_bytes() == b"hello"
+    assert (shard / "20241007_a_b.size").read_text() == "5"
+
+
+def test_pipeline_timeout(tmp_path: Path) -> None:
+    start = time.monotonic()
+    with plugins.PluginPipeline(
+        {"hang": hang, "size": write_size}, max_workers=1, timeout=0.2
+    ) as pipeline:
+        pipeline.submit(tmp_path / "x.bin", b"abc")
+
+    assert time.monotonic() - start < 5
+    # a hanging plugin does not block the others
+    assert (tmp_path / "x.size").read_text() == "3"
+
+
+def test_pipeline_backpressure(tmp_path: Path) -> None:
+    with plugins.PluginPipeline({"size": slow_size}, max_workers=1) as pipeline:
+        for number in range(6):
+            pipeline.submit(tmp_path / f"{number}.bin", b"abc")
+            assert len(pipeline._pending) <= pipeline.max_pending
+
+    assert len(list(tmp_path.glob("*.size"))) == 6
+
+
+def test_pipeline_stuck_worker(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(plugins, "STUCK_GRACE", 0.0)
+    start = time.monotonic()
+    with plugins.PluginPipeline(
+        {"stubborn": stubborn}, max_workers=1, timeout=0.2
+    ) as pipeline:
+        pipeline.submit(tmp_path / "x.bin", b"abc")
+        pipeline.wait()
+        # the pool is usable after the stuck worker was killed
+        pipeline.plugins = {"size": write_size}
+        pipeline.submit(tmp_path / "y.bin", b"abc")
+
+    assert time.monotonic() - start < 5
+    assert (tmp_path / "y.size").read_text() == "3"
+
+
+def test_pipeline_worker_crash(tmp_path: Path) -> None:
+    with plugins.PluginPipeline({"crash": crash}, max_workers=1) as pipeline:
+        pipeline.submit(tmp_path / "x.bin", b"abc")
+        time.sleep(0.5)
+        # the pool broke, it is replaced instead of failing the download
+        pipeline.submit(tmp_path / "y.bin", b"abc")
+        pipeline.wait()
+        pipeline.plugins = {"size": write_size}
+        pipeline.submit(tmp_path / "z.bin", b"abc")
+
+    assert (tmp_path / "z.size").read_text() == "3"
@@ -0,0 +1,153 @@
+import imaplib
+import threading
+from typing import Any, List, Tuple
+
+import pytest
+
+from miltonmail import core, ratelimit
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+def test_is_throttled() -> None:
+    assert ratelimit.is_throttled([b"[THROTTLED] Request is throttled"])
+    assert ratelimit.is_throttled("Account exceeded command or bandwidth limits")
+    assert not ratelimit.is_throttled([b"[NONEXISTENT] Unknown Mailbox"])
+    assert not ratelimit.is_throttled(None)
+
+
+def test_token_bucket() -> None:
+    clock = FakeClock()
+    limiter = ratelimit.RateLimiter(2.0, burst=3, clock=clock, sleep=clock.sleep)
+
+    # burst goes through without waiting
+    for _ in range(3):
+        limiter.acquire()
+    assert clock.now == 0.0
+
+    # then paced at the rate
+    limiter.acquire()
+    assert clock.now == pytest.approx(0.5)
+    limiter.acquire()
+    assert clock.now == pytest.approx(1.0)
+
+
+def test_aimd() -> None:
+    clock = FakeClock()
+    limiter = ratelimit.RateLimiter(
+        4.0, min_rate=0.5, increase=1.0, clock=clock, sleep=clock.sleep
+    )
+
+    limiter.on_throttle()
+    assert limiter.rate == 2.0
+    for _ in range(3):
+        limiter.on_throttle()
+    assert limiter.rate == 0.5
+
+    for _ in range(10):
+        limiter.on_success()
+    assert limiter.rate == 4.0
+
+
+class FakeConnection:
+    def __init__(self, responses: List[Any]) -> None:
+        self.responses = responses
+        self.selected: List[str] = []
+
+    def select(self, mailbox: str) -> Tuple[str, List[Any]]:
+        self.selected.append(mailbox)
+        return "OK", [b"1"]
+
+    def fetch(self, message_set: Any, message_parts: str) -> Tuple[str, List[Any]]:
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def shutdown(self) -> None:
+        pass
+
+
+def make_session(
+    monkeypatch: pytest.MonkeyPatch, connections: List[FakeConnection]
+) -> core.ImapSession:
+    monkeypatch.setattr(core, "login_to_imap", lambda *args: connections.pop(0))
+    monkeypatch.setattr(core.time, "sleep", lambda seconds: None)
+    return core.ImapSession("imap.test.com", "user", "secret", backoff=0.0)
+
+
+def test_session_retries_throttled(monkeypatch: pytest.MonkeyPatch) -> None:
+    conn = FakeConnection(
+        [("NO", [b"[THROTTLED] Request is throttled"]), ("OK", [b"data"])]
+    )
+    session = make_session(monkeypatch, [conn])
+
+    assert session.fetch(b"1", "(RFC822)") == ("OK", [b"data"])
+
+
+def test_session_reconnects_after_bye(monkeypatch: pytest.MonkeyPatch) -> None:
+    first = FakeConnection([imaplib.IMAP4.abort("socket error: EOF")])
+    second = FakeConnection([("OK", [b"data"])])
+    session = make_session(monkeypatch, [first, second])
+
+    session.select("INBOX")
+    assert session.fetch(b"1", "(RFC822)") == ("OK", [b"data"])
+    assert second.selected == ["INBOX"]
+
+
+def test_session_gives_up(monkeypatch: pytest.MonkeyPatch) -> None:
+    conn = FakeConnection([("NO", [b"[THROTTLED]"])] * 3)
+    session = make_session(monkeypatch, [conn])
+    session.max_retries = 2
+
+    assert session.fetch(b"1", "(RFC822)") == ("NO", [b"[THROTTLED]"])
+    assert not conn.responses
+
+
+def test_pacing_starts_when_throttled() -> None:
+    clock = FakeClock()
+    limiter = ratelimit.RateLimiter(increase=0.5, clock=clock, sleep=clock.sleep)
+
+    # not paced, 10 commands per second
+    for _ in range(10):
+        limiter.acquire()
+        clock.now += 0.1
+    assert limiter.rate is None
+
+    limiter.on_throttle()
+    assert limiter.rate == pytest.approx(5.0)
+
+    # probes above the rate it was throttled at
+    for _ in range(100):
+        limiter.acquire()
+        limiter.on_success()
+    assert limiter.rate > 10.0
+
+
+def test_shared_limiter() -> None:
+    delays: List[float] = []
+    limiter = ratelimit.RateLimiter(
+        10.0, burst=5, clock=lambda: 0.0, sleep=delays.append
+    )
+
+    def run() -> None:
+        for _ in range(25):
+            limiter.acquire()
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # every command got its own slot, the connections share the rate
+    assert sorted(delays) == pytest.approx([n / 10 for n in range(1, 96)])
@@ -0,0 +1,182 @@
+import tarfile
+import zipfile
+from datetime import date
+from email.message import EmailMessage
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from miltonmail import core, storage
+
+
+def make_message(payload: bytes) -> EmailMessage:
+    msg = EmailMessage()
+    msg["Subject"] = "test"
+    msg["Date"] = "Mon, 07 Oct 2024 10:00:00 +0000"
+    msg.set_content("body")
+    msg.add_attachment(
+        payload, maintype="application", subtype="pdf", filename="report.pdf"
+    )
+    return msg
+
+
+def test_directory_index(tmp_path: Path) -> None:
+    (tmp_path / "a.txt").write_bytes(b"abc")
+    (tmp_path / "subdir").mkdir()
+
+    index = storage.DirectoryIndex(tmp_path)
+    assert "a.txt" in index
+    assert "subdir" not in index
+    assert index.size("a.txt") == 3
+
+    index.add("b.txt", 5)
+    assert "b.txt" in index
+    assert len(index) == 2
+
+
+def test_missing_directory(tmp_path: Path) -> None:
+    assert len(storage.DirectoryIndex(tmp_path / "missing")) == 0
+
+
+def test_resolve_filename(tmp_path: Path) -> None:
+    (tmp_path / "f.pdf").write_bytes(b"abc")
+    index = storage.DirectoryIndex(tmp_path)
+
+    assert storage.resolve_filename(index, "new.pdf", b"x") == "new.pdf"
+    assert storage.resolve_filename(index, "f.pdf", b"other") is None
+    # same content is treated as the same attachment
+    assert storage.resolve_filename(index, "f.pdf", b"abc", "number") is None
+    assert storage.resolve_filename(index, "f.pdf", b"abc", "hash") is None
+    # same size, different content
+    assert storage.resolve_filename(index, "f.pdf", b"xyz", "number") == "f_1.pdf"
+    assert storage.resolve_filename(index, "f.pdf", b"other", "number") == "f_1.pdf"
+
+    name = storage.resolve_filename(index, "f.pdf", b"xyz", "hash")
+    assert name is not None and name.startswith("f_") and name.endswith(".pdf")
+    index.add(name, 3)
+    assert storage.resolve_filename(index, "f.pdf", b"xyz", "hash") is None
+
+    with pytest.raises(ValueError):
+        storage.resolve_filename(index, "f.pdf", b"other", "overwrite")
+
+
+@pytest.mark.parametrize("policy, expected", [("skip", 1), ("number", 3), ("hash", 3)])
+def test_save_collisions(tmp_path: Path, policy: str, expected: int) -> None:
+    store = storage.AttachmentStore(tmp_path)
+    for payload in (b"first", b"other", b"third!!!", b"other"):
+        core.save_attachments_from_message(
+            make_message(payload), tmp_path, store=store, collision=policy
+        )
+
+    shard = tmp_path / "2024" / "10"
+    assert len(list(shard.iterdir())) == expected
+    assert (shard / "20241007_report.pdf").read_bytes() == b"first"
+
+
+def test_shard_of() -> None:
+    assert storage.shard_of("20241007_report.pdf") == "2024/10"
+    assert storage.shard_of("report.pdf") is None
+
+
+def test_migrate(tmp_path: Path) -> None:
+    (tmp_path / "20241007_a.pdf").write_bytes(b"a")
+    (tmp_path / "20230101_b.pdf").write_bytes(b"b")
+    (tmp_path / "notes.txt").write_bytes(b"")
+
+    store = storage.AttachmentStore(tmp_path)
+    assert store.migrate() == 2
+    assert store.migrate() == 0
+
+    assert (tmp_path / "2024" / "10" / "20241007_a.pdf").exists()
+    assert (tmp_path / "notes.txt").exists()
+    assert store.shards() == ["2023/01", "2024/10"]
+
+
+@pytest.mark.parametrize("fmt", list(storage.ARCHIVE_FORMATS))
+def test_compact(tmp_path: Path, fmt: str) -> None:
+    for name in ("20220105_old.pdf", "20230301_mid.pdf", "20241007_new.pdf"):
+        (tmp_path / name).write_bytes(name.encode())
+    store = storage.AttachmentStore(tmp_path)
+    store.migrate()
+
+    today = date(2024, 10, 19)
+    report = store.compact(compact_after_months=12, fmt=fmt, today=today)
+
+    assert report.shards_archived == 2
+    assert report.files_archived == 2
+    assert store.shards() == ["2024/10"]
+    assert not (tmp_path / "2022").exists()
+
+    archive = tmp_path / "archive" / f"2022-01_1{storage.ARCHIVE_FORMATS[fmt]}"
+    if fmt == "zip":
+        with zipfile.ZipFile(archive) as zf:
+            assert zf.read("20220105_old.pdf") == b"20220105_old.pdf"
+    else:
+        with tarfile.open(archive) as tar:
+            assert tar.getnames() == ["20220105_old.pdf"]
+
+    # archived files still count as saved
+    assert "20220105_old.pdf" in store.index("20220105_old.pdf")
+    assert store.index("20220105_old.pdf").size("20220105_old.pdf") == 16
+    # archived content is still compared by digest
+    index = store.index("20220105_old.pdf")
+    assert storage.resolve_filename(index, "20220105_old.pdf", b"x" * 16, "number")
+    assert not storage.resolve_filename(
+        index, "20220105_old.pdf", b"20220105_old.pdf", "number"
+    )
+
+    report = store.compact(retention_months=24, today=today)
+    assert report.files_expired == 1
+    assert not archive.exists()
+    assert "20220105_old.pdf" in store.index("20220105_old.pdf")
+
+
+def test_sidecar_index(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    shard = tmp_path / "2024" / "10"
+    shard.mkdir(parents=True)
+    # saved before the sidecar index existed, its digest is read once
+    (shard / "20241007_report.pdf").write_bytes(b"AAAA")
+
+    store = storage.AttachmentStore(tmp_path)
+    for payload in (b"BBBB", b"AAAA"):
+        core.save_attachments_from_message(
+            make_message(payload), tmp_path, store=store, collision="number"
+        )
+
+    def read_file(path: Path) -> str:
+        raise AssertionError(f"{path} was read")
+
+    # later runs compare with the sidecar index, without reading the files
+    monkeypatch.setattr(storage, "file_digest", read_file)
+    store = storage.AttachmentStore(tmp_path)
+    for payload in (b"AAAA", b"BBBB", b"CCCC"):
+        core.save_attachments_from_message(
+            make_message(payload), tmp_path, store=store, collision="number"
+        )
+
+    assert sorted(path.read_bytes() for path in shard.iterdir()) == [
+        b"AAAA",
+        b"BBBB",
+        b"CCCC",
+    ]
+
+
+def test_shared_store(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    scanned = []
+
+    class CountingIndex(storage.DirectoryIndex):
+        def __init__(self, path: Path, sidecar: Optional[Path] = None) -> None:
+            scanned.append(path)
+            super().__init__(path, sidecar)
+
+    monkeypatch.setattr(storage, "DirectoryIndex", CountingIndex)
+    for payload in (b"first", b"other", b"third!!!"):
+        core.save_attachments_from_message(
+            make_message(payload), tmp_path, collision="number"
+        )
+
+    # the month shard and the flat layout directory, once each
+    assert sorted(scanned) == [tmp_path, tmp_path / "2024" / "10"]
+    assert storage.shared_store(tmp_path / ".") is storage.shared_store(tmp_path)
+    assert len(list((tmp_path / "2024" / "10").iterdir())) == 3